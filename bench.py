@@ -0,0 +1,172 @@
+# Codec and controller microbenchmarks
+#
+#   python bench.py                  run and print results
+#   python bench.py --save           save results as baseline
+#   python bench.py --compare        compare with baseline
+import argparse
+import json
+import time
+import tracemalloc
+
+import zwave
+from zwave import command
+from zwave import serialize
+from zwave.controller import frame
+
+BASELINE_FILE = "bench_baseline.json"
+
+# Number of timed runs per benchmark
+REPEAT = 5
+
+# Commands to encode, one of each type
+ENCODE = [
+    command.AssociationGet(1),
+    command.BasicSet(0xff),
+    command.BasicGet(),
+    command.BinarySwitchGet(),
+    command.BinarySwitchSet(0xff),
+    command.ConfigurationSet(58, 3599, "H"),
+    command.ConfigurationGet(58),
+    command.MeterGet(),
+    command.MultiChannelAssociationGet(1),
+    command.MultiChannelAssociationGroupingsGet(),
+    command.MultiChannelAssociationRemove(1, [2], [[1, 1]]),
+    command.MultiChannelAssociationSet(1, [2], [[1, 1]]),
+    command.MultilevelSwitchGet(),
+    command.MultilevelSwitchSet(50),
+    command.MultilevelSwitchSet(50, 5),
+    command.MultilevelSwitchStartLevelChange(True, 20, 5),
+    command.MultilevelSwitchStopLevelChange(),
+    command.WakeUpNoMoreInformation(),
+    command.MultiChannelEncap(1, command.BinarySwitchSet(0xff)),
+    command.MultiChannelEncap(2, command.MultiChannelEncap(1, command.BasicGet())),
+    command.MultiCommandEncap([command.MultiChannelEncap(1, command.BinarySwitchSet(0xff)),
+                               command.MultiChannelEncap(2, command.BinarySwitchSet(0))]),
+]
+
+# Reports to decode, as received from the serial port
+DECODE = {
+    'AssociationReport': [0x85, 0x03, 1, 5, 0, 1, 2],
+    'BasicReport': [0x20, 0x03, 0xff],
+    'BinarySwitchReport': [0x25, 0x03, 0xff],
+    'ConfigurationReport': [0x70, 0x06, 58, 2, 0x0e, 0x0f],
+    'MeterReport': [0x32, 0x02, 0x21, 0x44, 0, 0, 0x01, 0x2c],
+    'MultiChannelAssociationGroupingsReport': [0x8e, 0x06, 3],
+    'MultiChannelAssociationReport': [0x8e, 0x03, 1, 5, 0, 1, 2, 0, 3, 1],
+    'MultilevelSwitchReport': [0x26, 0x03, 50],
+    'MultiChannelEncap': [0x60, 0x0d, 1, 0, 0x25, 0x03, 0xff],
+    'MultiChannelEncap/nested': [0x60, 0x0d, 2, 0, 0x60, 0x0d, 1, 0, 0x20, 0x03, 0],
+    'WakeUpNotification': [0x84, 0x07],
+    'MultiCommandEncap': [0x8f, 0x01, 2, 3, 0x25, 0x03, 0xff, 3, 0x26, 0x03, 50],
+}
+
+# Time per call (seconds) and peak memory (bytes) allocated during a
+# call. tracemalloc gives the peak, not the number of allocations
+def measure(func, *args, number=None):
+    if number is None:
+        # Calibrate each run to take about 0.1s
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                func(*args)
+            if time.perf_counter() - start > 0.1:
+                break
+            number *= 2
+
+    # Best of several runs, to reduce noise
+    elapsed = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        t = (time.perf_counter() - start) / number
+        elapsed = t if elapsed is None else min(elapsed, t)
+
+    tracemalloc.start()
+    func(*args)
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+def benchmarks():
+    benches = {}
+
+    for cmd in ENCODE:
+        name = type(cmd).__name__
+        if type(cmd) is command.MultiChannelEncap:
+            name += "/" + type(cmd.command).__name__
+        elif getattr(cmd, 'duration', None) is not None:
+            name += "/duration"
+        benches['serialize/' + name] = (serialize.serialize, cmd)
+
+    for name, data in DECODE.items():
+        benches['deserialize/' + name] = (serialize.deserialize, bytes(data))
+
+    data = [0x01, 0x13, 0x06, 0x07, 0x60, 0x0d, 0x00, 0x01, 0x26, 0x01, 0x2d, 0x01, 0x21]
+    benches['zwave/checksum'] = (zwave.zwave.checksum, data)
+    benches['zwave/msg_str'] = (zwave.zwave.msg_str, data)
+
+    msg = [zwave.zwave.REQUEST, zwave.zwave.API_ZW_SEND_DATA, 6, 7,
+           0x60, 0x0d, 0x00, 0x01, 0x26, 0x01, 0x2d, 0x01, 0x21]
+    benches['controller/frame'] = (frame, msg)
+
+    # Receive dispatch from Serial API frame to endpoint
+    controller = zwave.Controller()
+    node = zwave.Node(controller, 6, "Bench")
+    zwave.MultilevelSwitch(node, 1, "Bench 1")
+    zwave.MultilevelSwitch(node, 2, "Bench 2")
+    report = bytes([0x00, 0x04, 0x00, 6, 7, 0x60, 0x0d, 1, 0, 0x26, 0x03, 50, 0x00])
+    benches['controller/process_msg'] = (controller.process_msg, report)
+
+    return benches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--save", action="store_true", help="Save baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="Compare with baseline")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="Slow down ratio reported as regression")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="Baseline file")
+    parser.add_argument("filter", nargs="?", default="",
+                        help="Only run benchmarks containing this string")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print("%-60s %14s %10s" % ("benchmark", "rate", "peak bytes"))
+
+    results = {}
+    regressions = 0
+    for name, (func, *func_args) in benchmarks().items():
+        if args.filter not in name:
+            continue
+
+        elapsed, peak = measure(func, *func_args)
+        results[name] = {'frames_per_sec': 1 / elapsed, 'peak_bytes': peak}
+
+        line = "%-60s %12.0f/s %8d B" % (name, 1 / elapsed, peak)
+        base = baseline.get(name)
+        if base:
+            ratio = base['frames_per_sec'] * elapsed
+            line += "  x%.2f" % ratio
+            if ratio > args.threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions:
+        raise SystemExit("%d regressions" % regressions)
@@ -0,0 +1,42 @@
+import argparse
+import json
+import sys
+
+import zwave_client
+
+# Reconcile can read and write every declared parameter
+RECONCILE_TIMEOUT = 600.0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Bring nodes to the configuration declared in config.yaml")
+    parser.add_argument("--address", "-a", help="Controller IP address", default="rpi")
+    parser.add_argument("--port", "-p", help="Controller port", default=5000)
+    parser.add_argument("--dry-run", "-n", action="store_true",
+                        help="Report drift without writing")
+    parser.add_argument("--budget", type=float,
+                        help="Radio airtime budget (frames/minute)")
+    parser.add_argument("--json", action="store_true", help="Print full report as JSON")
+    args = parser.parse_args()
+
+    url = f"http://{args.address}:{args.port}"
+
+    with zwave_client.Client(url, retries=0, timeout=RECONCILE_TIMEOUT) as client:
+        try:
+            report = client.reconcile(args.dry_run, args.budget)
+        except (zwave_client.ClientError, OSError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for node_id, node in report.items():
+            print(f"{node_id}: drift {node['drift']}")
+            for section in ['configuration', 'associations']:
+                for key, item in node[section].items():
+                    if item['status'] != 'ok':
+                        print(f"  {key}: {item['status']} "
+                              f"desired {item['desired']} actual {item['actual']}")
+
+    sys.exit(1 if any(node['drift'] for node in report.values()) else 0)
@@ -4,31 +4,107 @@ import gevent
 
 from flask import Flask, jsonify, current_app, request, abort
 from gevent import pywsgi
+import hashlib
 import logging
+import time
 import yaml
 import zwave
 
 def index():
     return "Hello World!"
 
+#----------------------------------------------------------------------
+# Request tracing
+
+def start_trace():
+    zwave.trace.start("%s %s" % (request.method, request.path))
+
+def finish_trace(response):
+    t = zwave.trace.current()
+    if t:
+        response.headers['Server-Timing'] = t.server_timing()
+        zwave.trace.finish()
+
+    return response
+
+# JSON response, timing the encoding
+def json_response(value):
+    start = time.monotonic()
+    response = jsonify(value)
+
+    t = zwave.trace.current()
+    if t:
+        t.add("json", start, time.monotonic())
+
+    return response
+
+#----------------------------------------------------------------------
+# Cached listings
+
+# Listings only change with the network configuration, so serialize them
+# once per configuration and serve with a strong ETag
+def cached_listing(key, build):
+    cache = current_app.config['LISTING_CACHE']
+
+    entry = cache.get(key)
+    if entry is None:
+        body = (current_app.json.dumps(build()) + "\n").encode()
+        entry = (body, hashlib.sha1(body).hexdigest())
+        cache[key] = entry
+
+    body, etag = entry
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = current_app.response_class(body, mimetype="application/json")
+
+    resp.set_etag(etag)
+    return resp
+
+# Install (or reload) the network, invalidating cached listings
+def set_network(app, zw):
+    app.config['ZWAVE'] = zw
+    app.config['LISTING_CACHE'] = {}
+
 #----------------------------------------------------------------------
 # Node access
 
 def get_nodes():
     nodes = current_app.config['ZWAVE']['nodes']
 
-    response = jsonify([{'id': n, 'name': nodes[n].name} for n in nodes])
-    return response
+    return cached_listing('nodes',
+            lambda: [{'id': n, 'name': nodes[n].name} for n in nodes])
 
 def get_config_params(node_id):
     node = current_app.config['ZWAVE']['nodes'].get(node_id)
     if node:
-        response = jsonify(list(node.config.keys()))
+        response = cached_listing(('config', node_id),
+                                  lambda: list(node.config.keys()))
     else:
         response = "Unknown node", 404
 
     return response
 
+# Node event journal, filtered by since/until (seconds since the epoch)
+# and type (tx, rx or both comma separated), latest limit events
+def get_events(node_id):
+    node = current_app.config['ZWAVE']['nodes'].get(node_id)
+    if node is None:
+        return "Unknown node", 404
+
+    types = None
+    if 'type' in request.args:
+        try:
+            types = {zwave.journal.EVENT_TYPES[t]
+                     for t in request.args['type'].split(",")}
+        except KeyError:
+            return "Bad event type", 400
+
+    return json_response(node.journal.query(request.args.get('since', type=float),
+                                            request.args.get('until', type=float),
+                                            types,
+                                            request.args.get('limit', type=int)))
+
 def get_config(node_id, param):
     node = current_app.config['ZWAVE']['nodes'].get(node_id)
     if node:
@@ -37,7 +113,7 @@ def get_config(node_id, param):
         if value is None:
             resp = "Unknown parameter", 404
         else:
-            resp = jsonify(value)
+            resp = json_response(value)
     else:
         resp = "Unknown node", 404
 
@@ -52,7 +128,8 @@ def set_config(node_id, param):
             logging.warning("Bad configuration value")
             return "Bad configuration value", 400
 
-        if node.set_configuration(param, value):
+        timeout = request.args.get('timeout', type=float)
+        if node.set_configuration(param, value, timeout=timeout):
             return ""
         else:
             return "Unknown configuration parameter", 404
@@ -68,7 +145,45 @@ def get_multi_channel_association(node_id, group):
         except gevent.Timeout:
             resp = "Z-Wave timeout", 500
         else:
-            resp = jsonify(value)
+            resp = json_response(value)
+    else:
+        logging.warning("Unknown node: %s" % node_id)
+        resp = "Unknown node", 404
+
+    return resp
+
+def get_multi_channel_associations(node_id):
+    node = current_app.config['ZWAVE']['nodes'].get(node_id)
+    if node:
+        refresh = request.args.get('refresh', 0, type=int)
+        try:
+            value = node.get_multi_channel_associations(refresh)
+        except gevent.Timeout:
+            resp = "Z-Wave timeout", 500
+        else:
+            resp = json_response(value)
+    else:
+        logging.warning("Unknown node: %s" % node_id)
+        resp = "Unknown node", 404
+
+    return resp
+
+# Update association table, sending only the differences
+def update_multi_channel_associations(node_id):
+    node = current_app.config['ZWAVE']['nodes'].get(node_id)
+    if node:
+        try:
+            desired = {int(g): a for g, a in request.get_json().items()}
+        except:
+            logging.warning("Bad association table")
+            return "Bad association table", 400
+
+        try:
+            changes = node.update_multi_channel_associations(desired)
+        except gevent.Timeout:
+            resp = "Z-Wave timeout", 500
+        else:
+            resp = json_response(changes)
     else:
         logging.warning("Unknown node: %s" % node_id)
         resp = "Unknown node", 404
@@ -105,6 +220,18 @@ def remove_multi_channel_association(node_id, group):
 
     return resp
 
+# Bring nodes to their declared configuration and associations, and
+# report drift by node. dry_run=1 only reports, budget sets the airtime
+# budget (frames/minute)
+def reconcile():
+    zw = current_app.config['ZWAVE']
+
+    reconciler = zwave.Reconciler(
+            zw['nodes'], zw.get('desired', {}),
+            request.args.get('budget', zwave.reconcile.RECONCILE_FRAMES_PER_MINUTE,
+                             type=float))
+    return json_response(reconciler.run(request.args.get('dry_run', 0, type=int)))
+
 #----------------------------------------------------------------------
 # Switch access
 
@@ -112,11 +239,10 @@ def remove_multi_channel_association(node_id, group):
 def get_switches():
     switches = current_app.config['ZWAVE']['switches']
 
-    switch_info = [
+    return cached_listing('switches', lambda: [
             {'id': s,
              'name': switches[s].name,
-             'type': type(switches[s]).__name__} for s in switches],
-    return jsonify(switch_info)
+             'type': type(switches[s]).__name__} for s in switches])
 
 # Get current switch state
 def get_switch(switch_id):
@@ -127,30 +253,115 @@ def get_switch(switch_id):
         except gevent.Timeout:
             resp = "Z-Wave timeout", 500
         else:
-            resp = jsonify(val)
+            resp = json_response(val)
     else:
         logging.warning("Unknown switch: %s" % switch_id)
         resp = "Unknown switch", 404
 
     return resp
 
-# Set switch state
+def switch_value_ok(switch, value):
+    if type(value) is not int:
+        return False
+
+    elif type(switch).__name__ == 'BinarySwitch':
+        return value in [0, 0xff]
+
+    elif type(switch).__name__ == 'MultilevelSwitch':
+        return (value >=0 and value < 100) or (value == 0xff)
+
+    else:
+        return False
+
+# Check switch reached value, 0xff is any on level
+def switch_value_matches(value, actual):
+    if value == 0xff:
+        return bool(actual)
+    else:
+        return actual == value
+
+# Longest time (seconds) to wait for a transition to finish before
+# reading back the level
+VERIFY_TRANSITION_WAIT = 10.0
+
+def duration_ok(duration):
+    return duration is None or \
+           (type(duration) in [int, float] and 0 <= duration <= zwave.zwave.MAX_DURATION)
+
+# Dimmer level change, {"level_change": "up"/"down"/"stop"} with optional
+# start_level and duration
+def set_level_change(switch, change):
+    timeout = request.args.get('timeout', type=float)
+
+    direction = change.get('level_change')
+    start_level = change.get('start_level')
+    duration = change.get('duration')
+
+    if type(switch).__name__ != 'MultilevelSwitch':
+        resp = "Level change needs a multilevel switch", 400
+    elif direction == 'stop':
+        switch.stop_level_change(timeout=timeout)
+        resp = ""
+    elif direction not in ['up', 'down'] or not duration_ok(duration) or \
+         not (start_level is None or
+              (type(start_level) is int and 0 <= start_level < 100)):
+        logging.warning("Bad level change: %s" % str(change))
+        resp = "Bad level change", 400
+    else:
+        switch.start_level_change(direction == 'up', start_level, duration,
+                                  timeout=timeout)
+        resp = ""
+
+    return resp
+
+# Set switch state, a value or {"value": value, "duration": seconds} for
+# a dimmer transition. With verify, wait for delivery (504 if it takes
+# longer than the timeout) and a short transition, and return the state
+# read back from the switch (409 if it doesn't match)
 def set_switch(switch_id):
     switch = current_app.config['ZWAVE']['switches'].get(switch_id)
     if switch:
         value = request.get_json()
-        if type(switch).__name__ == 'BinarySwitch':
-            val_ok = value in [0, 0xff]
-
-        elif type(switch).__name__ == 'MultilevelSwitch':
-            val_ok = (value >=0 and value < 100) or (value == 0xff)
 
-        else:
-            val_ok = False
-
-        if val_ok:
-            switch.set(value)
-            resp = ""
+        duration = None
+        if type(value) is dict:
+            if 'level_change' in value:
+                return set_level_change(switch, value)
+
+            duration = value.get('duration')
+            value = value.get('value')
+            if not duration_ok(duration) or \
+               (duration is not None and type(switch).__name__ != 'MultilevelSwitch'):
+                logging.warning("Bad duration: %s" % str(duration))
+                return "Bad duration", 400
+
+        if switch_value_ok(switch, value):
+            timeout = request.args.get('timeout', type=float)
+            if duration is None:
+                msg = switch.set(value, timeout=timeout)
+            else:
+                msg = switch.set(value, timeout=timeout, duration=duration)
+
+            if request.args.get('verify', 0, type=int):
+                # Delivery may be held for a sleeping node, wait no
+                # longer than the message may be queued
+                wait = timeout if timeout is not None else zwave.controller.MSG_TIMEOUT
+                try:
+                    msg.result.get(timeout=wait)
+                except gevent.Timeout:
+                    return "Z-Wave delivery timeout", 504
+
+                if duration:
+                    gevent.sleep(min(duration, VERIFY_TRANSITION_WAIT))
+                actual = switch.get()
+                resp = json_response(actual)
+
+                # Level is only checked once the transition has finished
+                finished = not duration or duration <= VERIFY_TRANSITION_WAIT
+                if finished and not switch_value_matches(value, actual):
+                    resp.status_code = 409
+            else:
+                resp = ""
         else:
             logging.warning("Bad switch value: %s" % str(value))
             resp = "Bad switch value", 400
@@ -160,13 +371,150 @@ def set_switch(switch_id):
 
     return resp
 
+# Set several switches, switch: value. Returns status by switch
+def set_switches():
+    switches = current_app.config['ZWAVE']['switches']
+
+    values = request.get_json()
+    if type(values) is not dict:
+        return "Bad switch values", 400
+
+    status = {}
+    for switch_id, value in values.items():
+        switch = switches.get(switch_id)
+        if switch is None:
+            status[switch_id] = "Unknown switch"
+        elif not switch_value_ok(switch, value):
+            status[switch_id] = "Bad switch value"
+        else:
+            try:
+                switch.set(value)
+            except zwave.QueueFull as e:
+                status[switch_id] = str(e)
+            else:
+                status[switch_id] = "OK"
+
+    return json_response(status)
+
+#----------------------------------------------------------------------
+# Schedule
+
+# Schedule totals and entries
+def get_schedules():
+    scheduler = current_app.config['ZWAVE']['scheduler']
+
+    status = scheduler.status()
+    status['schedules'] = {id: e.status() for id, e in scheduler.entries.items()}
+    return json_response(status)
+
+def get_schedule(schedule_id):
+    entry = current_app.config['ZWAVE']['scheduler'].entries.get(schedule_id)
+    if entry:
+        resp = json_response(entry.status())
+    else:
+        resp = "Unknown schedule", 404
+
+    return resp
+
+# Add or replace schedule
+def set_schedule(schedule_id):
+    zw = current_app.config['ZWAVE']
+
+    spec = request.get_json()
+    try:
+        zw['scheduler'].check(spec)
+    except ValueError as e:
+        logging.warning("Bad schedule: %s" % str(e))
+        return str(e), 400
+
+    for switch_id, value in spec['actions'].items():
+        if not switch_value_ok(zw['switches'][switch_id], value):
+            logging.warning("Bad switch value: %s" % str(value))
+            return "Bad switch value", 400
+
+    zw['scheduler'].add(schedule_id, spec)
+    return json_response(zw['scheduler'].entries[schedule_id].status())
+
+def remove_schedule(schedule_id):
+    if current_app.config['ZWAVE']['scheduler'].remove(schedule_id):
+        resp = ""
+    else:
+        resp = "Unknown schedule", 404
+
+    return resp
+
+#----------------------------------------------------------------------
+# Controller
+
+def get_queue():
+    controller = current_app.config['ZWAVE']['controller']
+    return json_response(controller.queue_status())
+
+# Liveness, with serial link state
+def get_health():
+    controller = current_app.config['ZWAVE']['controller']
+    return json_response(controller.link_status())
+
+# Readiness, serial link open and stick handshake complete
+def get_ready():
+    controller = current_app.config['ZWAVE']['controller']
+    status = controller.link_status()
+    return json_response(status), 200 if status['state'] == "ready" else 503
+
+# Transmit options and delivery statistics by node
+def get_routes():
+    controller = current_app.config['ZWAVE']['controller']
+    return json_response(controller.routes.status())
+
+# Neighbours, hops and latency by node. refresh=1 re-reads the neighbour
+# tables from the stick first
+def get_topology():
+    controller = current_app.config['ZWAVE']['controller']
+    if request.args.get('refresh', 0, type=int):
+        controller.refresh_topology()
+
+    return json_response(controller.topology.status())
+
+#----------------------------------------------------------------------
+# Memory
+
+# Internal table sizes, by owner
+def memory_tables(zw, listing_cache):
+    tables = {'controller': zw['controller'].table_sizes(),
+              'nodes': {n.id: n.table_sizes() for n in zw['nodes'].values()},
+              'listing_cache': len(listing_cache)}
+
+    if 'poller' in zw:
+        tables['poll_schedule'] = len(zw['poller'].schedule)
+    if 'scheduler' in zw:
+        tables['schedule'] = len(zw['scheduler'].schedule)
+
+    return tables
+
+# Memory use and internal table sizes. trace=1/0 starts or stops
+# allocation tracing, top=N sets the number of allocation sites reported
+def get_memory():
+    zw = current_app.config['ZWAVE']
+    cache = current_app.config['LISTING_CACHE']
+
+    trace = request.args.get('trace', type=int)
+    if trace:
+        zwave.memory.start_tracing()
+    elif trace == 0:
+        zwave.memory.stop_tracing()
+
+    return json_response(zwave.memory.report(
+            lambda: memory_tables(zw, cache),
+            request.args.get('top', zwave.memory.MEMORY_TOP_SITES, type=int)))
+
 #----------------------------------------------------------------------
 # Network
 
-def build_zwave(config_file, controller):
+def build_zwave(config_file, controller, poller=None):
     network = yaml.safe_load(config_file)
 
     nodes = {}
+    desired = {}
     for n in network['nodes']:
         name = n.get('name', "")
         config_file = n.get('config')
@@ -175,7 +523,20 @@ def build_zwave(config_file, controller):
         else:
             config = {}
 
-        nodes[n['id']] = zwave.Node(controller, n['node'], name, config)
+        node = zwave.Node(controller, n['node'], name, config,
+                          n.get('association_groups'), n.get('battery', False),
+                          n.get('multi_command', False))
+        nodes[n['id']] = node
+
+        # Declared parameter values and association groups, for reconcile
+        if 'configuration' in n or 'associations' in n:
+            desired[n['id']] = {'configuration': n.get('configuration', {}),
+                                'associations': n.get('associations', {})}
+
+        # Configuration parameter polls, parameter: interval
+        if poller:
+            for param, interval in n.get('poll', {}).items():
+                poller.add_configuration(node, param, interval)
 
     switches = {}
     for s in network.get('switches'):
@@ -188,7 +549,17 @@ def build_zwave(config_file, controller):
         endpoint = d.get('endpoint', 1)
         switches[d['id']] = zwave.MultilevelSwitch(nodes[d['nodeid']], endpoint, name)
 
-    return {'nodes': nodes, 'switches': switches}
+    # State and meter polls, state/meter: interval
+    if poller:
+        for s in network.get('switches') + network.get('dimmers'):
+            poll = s.get('poll', {})
+            if 'state' in poll:
+                poller.add_state(switches[s['id']], poll['state'])
+            if 'meter' in poll:
+                poller.add_meter(switches[s['id']], poll['meter'])
+
+    return {'controller': controller, 'nodes': nodes, 'switches': switches,
+            'desired': desired}
 
 #----------------------------------------------------------------------
 # Flask application
@@ -202,20 +573,49 @@ def handle_transmit_error(e):
 def handle_timeout_error(e):
     return "Z-Wave timeout", 404
 
+def handle_expired(e):
+    return "Z-Wave message expired", 504
+
+def handle_queue_full(e):
+    return "Z-Wave transmit queue full", 429, {'Retry-After': str(e.retry_after)}
+
 def create_app():
     app = Flask(__name__)
 
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+
     app.add_url_rule("/", view_func=index)
+    app.add_url_rule("/healthz", view_func=get_health, methods=['GET'])
+    app.add_url_rule("/readyz", view_func=get_ready, methods=['GET'])
 
     app.add_url_rule("/api/switch/", view_func=get_switches, methods=['GET'])
+    app.add_url_rule("/api/switch/", view_func=set_switches, methods=['PUT'])
     app.add_url_rule("/api/switch/<switch_id>", view_func=set_switch, methods=['PUT'])
     app.add_url_rule("/api/switch/<switch_id>", view_func=get_switch, methods=['GET'])
 
+    app.add_url_rule("/api/schedule/", view_func=get_schedules, methods=['GET'])
+    app.add_url_rule("/api/schedule/<schedule_id>", view_func=get_schedule, methods=['GET'])
+    app.add_url_rule("/api/schedule/<schedule_id>", view_func=set_schedule, methods=['PUT'])
+    app.add_url_rule("/api/schedule/<schedule_id>", view_func=remove_schedule, methods=['DELETE'])
+
+    app.add_url_rule("/api/admin/memory", view_func=get_memory, methods=['GET'])
+
+    app.add_url_rule("/api/controller/queue", view_func=get_queue, methods=['GET'])
+    app.add_url_rule("/api/controller/routes", view_func=get_routes, methods=['GET'])
+    app.add_url_rule("/api/controller/topology", view_func=get_topology, methods=['GET'])
+
     app.add_url_rule("/api/node/", view_func=get_nodes, methods=['GET'])
+    app.add_url_rule("/api/reconcile", view_func=reconcile, methods=['POST'])
+    app.add_url_rule("/api/node/<node_id>/events", view_func=get_events, methods=['GET'])
     app.add_url_rule("/api/node/<node_id>/config/", view_func=get_config_params, methods=['GET'])
     app.add_url_rule("/api/node/<node_id>/config/<param>", view_func=get_config, methods=['GET'])
     app.add_url_rule("/api/node/<node_id>/config/<param>", view_func=set_config, methods=['PUT'])
 
+    app.add_url_rule("/api/node/<node_id>/multi_channel_association/",
+                     view_func=get_multi_channel_associations, methods=['GET'])
+    app.add_url_rule("/api/node/<node_id>/multi_channel_association/",
+                     view_func=update_multi_channel_associations, methods=['PUT'])
     app.add_url_rule("/api/node/<node_id>/multi_channel_association/<int:group>",
                      view_func=get_multi_channel_association, methods=['GET'])
     app.add_url_rule("/api/node/<node_id>/multi_channel_association/<int:group>",
@@ -227,6 +627,8 @@ def create_app():
     app.register_error_handler(404, handle_not_found)
     app.register_error_handler(zwave.TransmitError, handle_transmit_error)
     app.register_error_handler(zwave.Timeout, handle_timeout_error)
+    app.register_error_handler(zwave.QueueFull, handle_queue_full)
+    app.register_error_handler(zwave.Expired, handle_expired)
 
     return app
 
@@ -243,9 +645,21 @@ if __name__ == "__main__":
                         default="WARNING")
     parser.add_argument("--logdir", help="Log file directory")
     parser.add_argument("-s", "--serial", default="/dev/ttyACM0",
-                        help="Z-Wave controller serial device")
+                        help="Z-Wave controller serial device, tcp://host:port "
+                             "or unix:///path")
     parser.add_argument("-p", "--port", default="5000", type=int,
                         help="HTTP server port")
+    parser.add_argument("--trace", help="Trace export file, or udp://host:port")
+    parser.add_argument("--poll-budget", default=zwave.poll.POLL_FRAMES_PER_MINUTE,
+                        type=float, help="Polling budget (frames/minute)")
+    parser.add_argument("--schedule-file", default="schedule.json",
+                        help="Switch schedule file")
+    parser.add_argument("--tracemalloc", default=0, type=int, metavar="FRAMES",
+                        help="Trace allocations from start up, recording FRAMES frames")
+    parser.add_argument("--memory-report", default=0, type=float, metavar="SECONDS",
+                        help="Log memory use and allocation growth periodically")
+    parser.add_argument("--memory-budget", type=float, metavar="MB",
+                        help="Exit if resident memory exceeds budget (needs --memory-report)")
     args = parser.parse_args()
 
     # Configure logging
@@ -267,15 +681,31 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(format="%(asctime)s,%(msecs)d:%(levelname)s:%(message)s", datefmt="%H:%M:%S")
 
+    zwave.trace.set_exporter(args.trace)
+
+    if args.tracemalloc:
+        zwave.memory.start_tracing(args.tracemalloc)
+
     controller = zwave.Controller()
+    poller = zwave.Poller(controller, args.poll_budget)
 
-    zw = build_zwave(args.config_file, controller)
+    zw = build_zwave(args.config_file, controller, poller)
+    zw['scheduler'] = zwave.Scheduler(zw['switches'], args.schedule_file)
+    zw['poller'] = poller
 
     controller.open(args.serial)
     controller.start()
+    poller.start()
+    zw['scheduler'].start()
 
     app = create_app()
-    app.config['ZWAVE'] = zw
+    set_network(app, zw)
+
+    if args.memory_report:
+        budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        zwave.memory.MemoryMonitor(
+                lambda: memory_tables(zw, app.config['LISTING_CACHE']),
+                args.memory_report, budget).start()
 
     server = pywsgi.WSGIServer(('0.0.0.0', args.port), app)
     server.serve_forever()
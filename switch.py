@@ -1,14 +1,8 @@
 import argparse
-import requests
-import time
 import sys
+import time
 
-def set(url, value):
-    put_req = requests.put(url, json=args.value)
-    time.sleep(1)
-    get_req = requests.get(url)
-
-    return get_req.json() == value
+import zwave_client
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -16,19 +10,31 @@ if __name__ == '__main__':
     parser.add_argument("value", type=int, help="Switch value")
     parser.add_argument("--address", "-a", help="Controller IP address", default="rpi")
     parser.add_argument("--port", "-p", help="Controller port", default=5000)
-    parser.add_argument("--retries", type=int, help="Number of retries", default=3)
-    parser.add_argument("--delay", type=int, help="Delay between retries (s)", default=10)
+    parser.add_argument("--retries", type=int, help="Number of attempts to set and verify",
+                        default=3)
+    parser.add_argument("--http-retries", type=int,
+                        help="Number of retries of each HTTP request", default=0)
+    parser.add_argument("--delay", type=float, help="Maximum delay between retries (s)",
+                        default=10)
     args = parser.parse_args()
 
-    url = f"http://{args.address}:{args.port}/api/switch/{args.switch}"
-
-    for i in range(args.retries - 1):
-        if set(url, args.value):
-            sys.exit(0)
+    url = f"http://{args.address}:{args.port}"
 
-        print("Retrying...", file=sys.stderr)
-        time.sleep(args.delay)
+    # Transport errors are retried by the client, failed verification here
+    with zwave_client.Client(url, retries=args.http_retries,
+                             max_backoff=args.delay) as client:
+        for attempt in range(args.retries):
+            try:
+                client.set_switch(args.switch, args.value, verify=True)
+                sys.exit(0)
+            except zwave_client.VerifyError as e:
+                print(e, file=sys.stderr)
+                if attempt < args.retries - 1:
+                    print("Retrying...", file=sys.stderr)
+                    time.sleep(zwave_client.retry_delay(attempt, max_backoff=args.delay))
+            except (zwave_client.ClientError, OSError) as e:
+                print(e, file=sys.stderr)
+                break
 
-    if not set(url, args.value):
-        print(f"Failed to set {args.switch} to value {args.value}", file=sys.stderr)
-        sys.exit(1)
+    print(f"Failed to set {args.switch} to value {args.value}", file=sys.stderr)
+    sys.exit(1)
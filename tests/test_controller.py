@@ -0,0 +1,152 @@
+import gevent
+from gevent.queue import Empty, Queue
+
+import zwave
+from zwave import zwave as zw
+
+# Stick which sends its ACK and the following frame back to back, so
+# both arrive in the same read
+class FakeSerial:
+    def __init__(self):
+        self.rx = Queue()
+        self.written = []
+
+        # Nodes which never send a transmit callback
+        self.silent = set()
+
+        # Number of send data frames to refuse
+        self.nak = 0
+
+        # Number of send data writes to fail, as for a lost link
+        self.fail_writes = 0
+
+    def read(self, n=1):
+        out = b""
+        while len(out) < n:
+            try:
+                out += bytes([self.rx.get(timeout=0.2)])
+            except Empty:
+                break
+        return out
+
+    def write(self, buf):
+        buf = bytes(buf)
+        self.written.append(buf)
+        if buf[0] != zw.SOF:
+            return
+
+        func = buf[3]
+        if func == zw.API_ZW_SEND_DATA and self.fail_writes:
+            self.fail_writes -= 1
+            raise OSError("write failed")
+
+        if func == zw.API_ZW_SEND_DATA and self.nak:
+            self.nak -= 1
+            self.rx.put(zw.NAK)
+            return
+
+        if func == zw.API_ZW_GET_VERSION:
+            reply = [zw.REQUEST, func] + list(b"Z-Wave 4.05\0") + [1]
+        elif func == zw.API_ZW_SEND_DATA and buf[4] not in self.silent:
+            reply = [0, func, buf[-2], zw.TRANSMIT_COMPLETE_OK]
+        else:
+            reply = None
+
+        data = [zw.ACK]
+        if reply:
+            data += zwave.controller.frame(reply)
+        for b in data:
+            self.rx.put(b)
+
+    def close(self):
+        pass
+
+def start_controller():
+    c = zwave.Controller()
+    c.ser = FakeSerial()
+    c.dev = "fake"
+    c.link_open.set()
+    c.start()
+    return c
+
+def test_ack_followed_by_frame_handshake():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+    assert c.version == "Z-Wave 4.05"
+    assert c.rx_collisions == 0
+
+def test_ack_followed_by_frame_send_data():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    msg = c.send_data([4, 3, zw.COMMAND_CLASS_SWITCH_BINARY, zw.SWITCH_BINARY_SET, 0xff])
+    assert msg.result.get(timeout=5) == zw.TRANSMIT_COMPLETE_OK
+
+    sent = [w for w in c.ser.written if w[0] == zw.SOF and w[3] == zw.API_ZW_SEND_DATA]
+    assert len(sent) == 1
+    assert c.rx_collisions == 0
+
+def test_cancelled_message_not_escalated(monkeypatch):
+    monkeypatch.setattr(zwave.controller, "TX_TIMEOUT", 0.5)
+    monkeypatch.setattr(zwave.endpoint, "TIMEOUT", 0.2)
+
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+    c.ser.silent.add(4)
+
+    node = zwave.Node(c, 4, "Socket")
+    switch = zwave.BinarySwitch(node, 1)
+    assert switch.get() is None
+    gevent.sleep(1.5)
+
+    sent = [w for w in c.ser.written if w[0] == zw.SOF and w[3] == zw.API_ZW_SEND_DATA]
+    assert len(sent) == 1
+    assert c.expired == 1
+    assert c.routes.route(4).outcomes[0] == [0, 0]
+
+def test_get_expired_in_queue(monkeypatch):
+    monkeypatch.setattr(zwave.endpoint, "TIMEOUT", 0.3)
+
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    # Slow node, so the caller waits longer than the message may queue
+    node = zwave.Node(c, 4, "Socket")
+    switch = zwave.BinarySwitch(node, 1)
+    c.routes.route(4).latency = 1.0
+
+    c.link_ready.clear()
+    get = gevent.spawn(switch.get)
+    gevent.sleep(0.5)
+    c.link_ready.set()
+
+    get.join(timeout=2)
+    assert isinstance(get.exception, zwave.Expired)
+
+def test_frame_budget_send_data_only():
+    c = zwave.Controller()
+    c.ser = FakeSerial()
+    c.dev = "fake"
+    c.link_open.set()
+    c.frame_budget = zwave.controller.TokenBucket(0.001, 1)
+    c.ser.nak = 1
+    c.start()
+
+    # Handshake and CAN/NAK retries don't use the radio
+    assert c.link_ready.wait(timeout=2)
+    msg = c.send_data([4, 3, zw.COMMAND_CLASS_SWITCH_BINARY, zw.SWITCH_BINARY_SET, 0xff])
+    assert msg.result.get(timeout=2) == zw.TRANSMIT_COMPLETE_OK
+    assert msg.attempts == 2
+
+def test_requeue_after_link_failure(monkeypatch):
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    ser = c.ser
+    ser.fail_writes = 1
+    monkeypatch.setattr(zwave.controller, "open_transport", lambda dev: ser)
+
+    msg = c.send_data([4, 3, zw.COMMAND_CLASS_SWITCH_BINARY, zw.SWITCH_BINARY_SET, 0xff])
+    assert msg.result.get(timeout=5) == zw.TRANSMIT_COMPLETE_OK
+    assert c.reconnects == 1
+    assert c.node_queued[4] == 0
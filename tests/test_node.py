@@ -0,0 +1,104 @@
+import gevent
+
+import zwave
+from zwave import serialize
+from zwave import zwave as zw
+
+from test_controller import start_controller
+
+def test_coalesced_batch_result():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    node = zwave.Node(c, 6, "Dimmer", multi_command=True)
+    dimmer = zwave.MultilevelSwitch(node, 1)
+
+    # Hold transmitter so the second batch coalesces into the queued first
+    c.link_ready.clear()
+    msgs = [dimmer.set(10)]
+    gevent.sleep(0.1)
+    msgs.append(dimmer.set(20))
+    gevent.sleep(0.1)
+    c.link_ready.set()
+
+    assert [m.result.get(timeout=5) for m in msgs] == [0, 0]
+
+def test_batch_queue_full():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+    c.link_ready.clear()
+
+    node = zwave.Node(c, 6, "Dimmer", multi_command=True)
+    try:
+        for i in range(zwave.controller.MAX_NODE_QUEUE_DEPTH + 1):
+            node.send_command(zwave.BasicGet())
+            gevent.sleep(0.1)
+    except zwave.QueueFull:
+        pass
+    else:
+        assert False, "QueueFull not raised"
+
+def test_multi_command_skips_unknown():
+    data = [0x8f, 0x01, 3, 2, 0x99, 0x01, 2, 0x84, 0x07, 3, 0x25, 0x03, 0xff]
+    cmd = serialize.deserialize(bytes(data))
+    assert [type(c) for c in cmd.commands] == \
+            [zwave.WakeUpNotification, zwave.BinarySwitchReport]
+
+def test_journal_endpoints_match():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    node = zwave.Node(c, 5, "Socket")
+    switch = zwave.BinarySwitch(node, 1)
+    switch.set(0xff).result.get(timeout=5)
+    node.response(bytes([0x25, 0x03, 0xff]))
+    node.response(bytes([0x70, 0x06, 20, 1, 2]))
+
+    events = node.journal.query()
+    assert [(e['type'], e['endpoint'], e['command_class']) for e in events] == \
+            [('tx', 1, 0x25), ('rx', 1, 0x25), ('rx', 0, 0x70)]
+
+def test_journal_multi_command():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    node = zwave.Node(c, 4, "Relay", multi_command=True)
+    zwave.BinarySwitch(node, 1)
+    zwave.BinarySwitch(node, 2)
+    msgs = [node.endpoints[1].set(0xff), node.endpoints[2].set(0)]
+    for m in msgs:
+        m.result.get(timeout=5)
+
+    events = node.journal.query(types={zwave.journal.EVENT_TX})
+    assert [(e['endpoint'], e['command_class'], e['value']) for e in events] == \
+            [(1, 0x25, 0xff), (2, 0x25, 0)]
+
+def test_set_then_stop_level_change():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+
+    node = zwave.Node(c, 6, "Dimmer")
+    dimmer = zwave.MultilevelSwitch(node, 1)
+
+    # Hold transmitter so the set is still queued when stop is called
+    c.link_ready.clear()
+    msgs = [dimmer.set(50), dimmer.stop_level_change()]
+    c.link_ready.set()
+
+    assert [m.result.get(timeout=5) for m in msgs] == [0, 0]
+
+    sent = [w[6:8] for w in c.ser.written
+            if w[0] == zw.SOF and w[3] == zw.API_ZW_SEND_DATA]
+    assert sent == [bytes([0x26, 0x01]), bytes([0x26, 0x05])]
+
+def test_journal_attempts_include_retries():
+    c = start_controller()
+    assert c.link_ready.wait(timeout=2)
+    c.ser.nak = 2
+
+    node = zwave.Node(c, 5, "Socket")
+    switch = zwave.BinarySwitch(node, 1)
+    assert switch.set(0xff).result.get(timeout=5) == 0
+
+    events = node.journal.query(types={zwave.journal.EVENT_TX})
+    assert [e['attempts'] for e in events] == [3]
@@ -1,4 +1,12 @@
 from .command import *
-from .controller import Controller, TransmitError, Timeout
+from .controller import Controller, Message
+from .controller import TransmitError, Timeout, QueueFull, Expired
+from .controller import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from .endpoint import Endpoint, BinarySwitch, MultilevelSwitch
 from .node import Node
+from .poll import Poller
+from .reconcile import Reconciler
+from .schedule import Scheduler
+from . import journal
+from . import memory
+from . import trace
@@ -91,6 +91,9 @@ class ConfigurationReport(ConfigurationClass):
 class Meter(Command):
     CLASS = zwave.COMMAND_CLASS_METER
 
+class MeterGet(Meter):
+    COMMAND = zwave.METER_GET
+
 class MeterReport(Meter):
     COMMAND = zwave.METER_REPORT
 
@@ -104,6 +107,15 @@ class MultiChannelEncap(MultiChannel):
         self.endpoint = endpoint
         self.command = command
 
+class MultiCommand(Command):
+    CLASS = zwave.COMMAND_CLASS_MULTI_CMD
+
+class MultiCommandEncap(MultiCommand):
+    COMMAND = zwave.MULTI_CMD_ENCAP
+
+    def __init__(self, commands=None):
+        self.commands = commands
+
 class MultiChannelAssociation(Command):
     CLASS = zwave.COMMAND_CLASS_MULTI_CHANNEL_ASSOCIATION_V2
 
@@ -113,6 +125,15 @@ class MultiChannelAssociationGet(MultiChannelAssociation):
     def __init__(self, group):
         self.group = group
 
+class MultiChannelAssociationGroupingsGet(MultiChannelAssociation):
+    COMMAND = zwave.MULTI_CHANNEL_ASSOCIATION_GROUPINGS_GET_V2
+
+class MultiChannelAssociationGroupingsReport(MultiChannelAssociation):
+    COMMAND = zwave.MULTI_CHANNEL_ASSOCIATION_GROUPINGS_REPORT_V2
+
+    def __init__(self, groupings=0):
+        self.groupings = groupings
+
 class MultiChannelAssociationRemove(MultiChannelAssociation):
     COMMAND = zwave.MULTI_CHANNEL_ASSOCIATION_REMOVE_V2
 
@@ -140,17 +161,42 @@ class MultiChannelAssociationSet(MultiChannelAssociation):
         self.nodes = nodes
         self.multi_channel_nodes = multi_channel_nodes
 
+class WakeUp(Command):
+    CLASS = zwave.COMMAND_CLASS_WAKE_UP
+
+class WakeUpNotification(WakeUp):
+    COMMAND = zwave.WAKE_UP_NOTIFICATION
+
+class WakeUpNoMoreInformation(WakeUp):
+    COMMAND = zwave.WAKE_UP_NO_MORE_INFORMATION
+
 class MultilevelSwitchCommand(Command):
     CLASS = zwave.COMMAND_CLASS_SWITCH_MULTILEVEL
 
 class MultilevelSwitchGet(MultilevelSwitchCommand):
     COMMAND = zwave.SWITCH_MULTILEVEL_GET
 
+# Duration (seconds) of the transition needs version 2, None leaves it to
+# the device
 class MultilevelSwitchSet(MultilevelSwitchCommand):
     COMMAND = zwave.SWITCH_MULTILEVEL_SET
 
-    def __init__(self, value=99):
+    def __init__(self, value=99, duration=None):
         self.value = value
+        self.duration = duration
+
+# Start dimming up or down, from start_level if given, until stopped or
+# the end of the range is reached after duration seconds
+class MultilevelSwitchStartLevelChange(MultilevelSwitchCommand):
+    COMMAND = zwave.SWITCH_MULTILEVEL_START_LEVEL_CHANGE
+
+    def __init__(self, up=True, start_level=None, duration=None):
+        self.up = up
+        self.start_level = start_level
+        self.duration = duration
+
+class MultilevelSwitchStopLevelChange(MultilevelSwitchCommand):
+    COMMAND = zwave.SWITCH_MULTILEVEL_STOP_LEVEL_CHANGE
 
 class MultilevelSwitchReport(MultilevelSwitchCommand):
     COMMAND = zwave.SWITCH_MULTILEVEL_REPORT
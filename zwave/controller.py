@@ -1,12 +1,23 @@
+import collections
+import itertools
 import logging
+import math
+import time
 
 import gevent
-from gevent.queue import Queue
-from gevent.event import AsyncResult
+from gevent.queue import Full, PriorityQueue, Queue
+from gevent.event import AsyncResult, Event
+from gevent.lock import Semaphore
 
 import serial
 
+from . import trace
 from . import zwave
+from .events import EventHub
+from .journal import OUTCOME_ERROR, OUTCOME_EXPIRED, OUTCOME_TIMEOUT
+from .transport import open_transport
+from .ratelimit import TokenBucket
+from .routing import RouteStats, Topology, node_mask
 
 # Time to wait for Z-Wave stick to acknowledge
 ACK_TIMEOUT = 0.5
@@ -17,9 +28,50 @@ TX_TIMEOUT = 2.0
 # Max number of retries following CAN or NAK
 MAX_TX_RETRIES = 3
 
+# Time to wait for Z-Wave stick to respond to a function request
+REQUEST_TIMEOUT = 1.0
+
+# Consecutive ACK timeouts before serial link is considered dead
+MAX_ACK_TIMEOUTS = 5
+
+# Delay (seconds) between attempts to reopen serial link, doubling up to
+# the maximum
+REOPEN_DELAY = 0.5
+MAX_REOPEN_DELAY = 30.0
+
 MIN_TXMSG_ID = 0x20
 MAX_TXMSG_ID = 0xff
 
+# Maximum number of queued messages, overall and per node
+MAX_QUEUE_DEPTH = 32
+MAX_NODE_QUEUE_DEPTH = 8
+
+# Radio frame rate limit, frames/second and burst size
+TX_FRAME_RATE = 5.0
+TX_FRAME_BURST = 10
+
+# Maximum number of received messages waiting to be processed
+MAX_RX_QUEUE_DEPTH = 64
+
+# Interval (seconds) between reads of the neighbour tables
+TOPOLOGY_REFRESH = 6 * 3600.0
+TOPOLOGY_RETRY = 60.0
+
+# Time (seconds) to wait for the transmit queue to empty before reading
+# a node's neighbours
+TOPOLOGY_IDLE_WAIT = 0.2
+
+# Default time (seconds) a message may wait in the queue
+MSG_TIMEOUT = 30.0
+
+# Smoothing factor for measured time per message
+TX_TIME_ALPHA = 0.2
+
+# Transmit priorities, lowest value is sent first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
 ACK_STR = {zwave.ACK: "ACK", zwave.NAK: "NAK", zwave.CAN: "CAN"}
 
 class TransmitError(Exception):
@@ -33,98 +85,543 @@ class Timeout(Exception):
     def __str__(self):
         return "Z-Wave timeout"
 
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "Z-Wave transmit queue full, retry after %ds" % self.retry_after
+
+class Expired(Exception):
+    def __str__(self):
+        return "Z-Wave message expired before transmission"
+
+# Queued message. The result is set to the transmit status from the
+# remote node, or to an exception if the message isn't delivered.
+# Queued messages with the same (non-None) key are coalesced
+class Message:
+    def __init__(self, data, priority=PRIORITY_NORMAL, node=None, timeout=None,
+                 key=None):
+        self.data = data
+        self.priority = priority
+        self.node = node
+        self.key = key
+        self.queued = time.monotonic()
+        self.deadline = self.queued + (MSG_TIMEOUT if timeout is None else timeout)
+        self.result = AsyncResult()
+        self.trace = trace.current()
+
+        # Number of times sent to the stick, including retries
+        self.attempts = 0
+
+    def expired(self, now):
+        return now > self.deadline
+
+    # Caller is no longer interested, drop message if not yet sent
+    def cancel(self):
+        self.deadline = 0
+
+    def cancelled(self):
+        return self.deadline == 0
+
+# Wait up to timeout seconds for report, the response to msg. Raises the
+# message's exception (e.g. Expired) if it isn't delivered, rather than
+# waiting out the timeout, or gevent.Timeout
+def wait_report(report, msg, timeout):
+    end = time.monotonic() + timeout
+    gevent.wait([report, msg.result], timeout=timeout, count=1)
+
+    if not report.ready() and msg.result.ready() and not msg.result.successful():
+        raise msg.result.exception
+
+    return report.get(timeout=max(0, end - time.monotonic()))
+
+# Serial API data frame for message
+def frame(msg):
+    payload = [len(msg) + 1] + msg
+    return bytes([zwave.SOF] + payload + [zwave.checksum(payload)])
+
 class Controller:
     def __init__(self):
-        self.msg_q = Queue()
+        self.msg_q = PriorityQueue()
+        self.msg_seq = itertools.count()
+        self.node_queued = collections.Counter()
+        self.coalesce = {}
         self.nodes = {}
 
+        self.frame_budget = TokenBucket(TX_FRAME_RATE, TX_FRAME_BURST)
+        self.tx_time = ACK_TIMEOUT
+        self.rejected = 0
+        self.rejected_node = 0
+        self.expired = 0
+        self.coalesced = 0
+
         self.ack_result = None
+        self.ack_timeouts = 0
+
+        # Received messages are acknowledged on receipt and processed by
+        # a separate greenlet
+        self.rx_q = Queue(MAX_RX_QUEUE_DEPTH)
+        self.rx_dropped = 0
+        self.rx_collisions = 0
 
         self.txmsg_id = MIN_TXMSG_ID
         self.tx_result = {}
+        self.func_result = {}
+
+        # Serial link state. The receiver runs while the link is open, the
+        # transmitter once the stick has answered the handshake
+        self.ser = None
+        self.tx_lock = Semaphore()
+        self.link_open = Event()
+        self.link_ready = Event()
+        self.link_failed = Event()
+        self.link_error = None
+        self.ready_time = None
+        self.reconnects = 0
+        self.version = None
+
+        self.routes = RouteStats()
+        self.topology = Topology(self.routes)
+        self.events = EventHub()
 
     # Register a node (to get received messages)
     def register_node(self, node):
         self.nodes[node.id] = node
 
-    # Open serial device
+    # Subscribe to received commands, callback(node, endpoint, cmd) is
+    # called from a separate greenlet. Returns Subscription
+    def subscribe(self, callback, command_class=None, node=None, endpoint=None):
+        return self.events.subscribe(callback, command_class, node, endpoint)
+
+    # Open serial device, tcp://host:port or unix:///path
     def open(self, dev):
         self.dev = dev
-        self.ser = serial.Serial(self.dev, timeout=1.0)
+        self.ser = open_transport(self.dev)
+        self.link_open.set()
 
-    # Start transmit and receive processes
+    # Start transmit, receive and link supervisor processes
     def start(self):
         gevent.spawn(self.transmit)
         gevent.spawn(self.receive)
-
-    # Queue Z-Wave data for transmission to remote node
-    def send_data(self, data):
-        msg = [zwave.REQUEST, zwave.API_ZW_SEND_DATA] + data
-        self.msg_q.put(msg)
-
+        gevent.spawn(self.dispatch)
+        gevent.spawn(self.supervise)
+        gevent.spawn(self.maintain_topology)
+
+    def link_status(self):
+        if self.link_ready.is_set():
+            state = "ready"
+        elif self.link_open.is_set():
+            state = "handshake"
+        else:
+            state = "down"
+
+        return {'state': state,
+                'device': getattr(self, 'dev', None),
+                'version': self.version,
+                'ready_time': self.ready_time,
+                'error': self.link_error,
+                'reconnects': self.reconnects}
+
+    # Queue Z-Wave data for transmission to remote node. The message is
+    # dropped if it hasn't been sent within timeout seconds, and replaces
+    # any unsent message with the same key
+    def send_data(self, data, priority=PRIORITY_NORMAL, timeout=None, key=None):
+        msg = Message([zwave.REQUEST, zwave.API_ZW_SEND_DATA] + data,
+                      priority, data[0], timeout, key)
+        return self.queue_msg(msg)
+
+    # Z-Wave library version string and type
     def get_version(self):
-        msg = [zwave.REQUEST, zwave.API_ZW_GET_VERSION]
-        self.msg_q.put(msg)
+        data = self.request(zwave.API_ZW_GET_VERSION)
+        return data[:-1].split(b"\0")[0].decode("ascii", "replace"), data[-1]
 
     def get_init_data(self):
-        msg = [zwave.REQUEST, zwave.API_GET_INIT_DATA]
-        self.msg_q.put(msg)
+        return self.request(zwave.API_GET_INIT_DATA)
+
+    # Home ID and the stick's node ID
+    def get_id(self):
+        data = self.request(zwave.API_MEMORY_GET_ID)
+        return int.from_bytes(data[:4], "big"), data[4]
+
+    # Node's neighbours, from the stick's routing table
+    def get_routing_info(self, node):
+        data = self.request(zwave.API_ZW_GET_ROUTING_INFO, [node, 0, 0, 0])
+        return node_mask(data[:zwave.NODE_MASK_LEN])
+
+    # Read neighbours of the stick and registered nodes, giving way to
+    # queued messages
+    def refresh_topology(self):
+        if self.topology.controller_id is None:
+            self.topology.controller_id = self.get_id()[1]
+
+        for node in [self.topology.controller_id] + sorted(self.nodes):
+            while not self.idle():
+                gevent.sleep(TOPOLOGY_IDLE_WAIT)
+
+            self.topology.update(node, self.get_routing_info(node))
+
+    # Send function request to Z-Wave stick and return response data.
+    # Raises TransmitError if the request isn't accepted, or Timeout
+    def request(self, func, data=()):
+        with self.tx_lock:
+            result = AsyncResult()
+            self.func_result[func] = result
+
+            ack = self.transmit_msg([zwave.REQUEST, func] + list(data))
+            if ack != zwave.ACK:
+                self.func_result.pop(func, None)
+                raise TransmitError(zwave.TRANSMIT_COMPLETE_FAIL)
+
+            try:
+                return result.get(timeout=REQUEST_TIMEOUT)
+            except gevent.Timeout:
+                raise Timeout()
+            finally:
+                self.func_result.pop(func, None)
+
+    # Messages are sent in priority order, FIFO within each priority.
+    # Raises QueueFull if the queue (or the node's share) is full
+    def queue_msg(self, msg):
+        # Last writer wins, the queued message takes the new data and its
+        # callers share the result of sending it
+        queued = self.coalesce.get(msg.key)
+        if queued is not None:
+            logging.debug("Tx coalesced: %s" % zwave.msg_str(msg.data))
+            queued.data = msg.data
+            queued.deadline = max(queued.deadline, msg.deadline)
+            self.coalesced += 1
+            return queued
+
+        self.check_capacity(msg.node)
+
+        node = msg.node
+        if node is not None:
+            self.node_queued[node] += 1
+        if msg.key is not None:
+            self.coalesce[msg.key] = msg
+        self.msg_q.put((msg.priority, next(self.msg_seq), msg))
+        return msg
+
+    # Raise QueueFull if the queue, or node's share of it, is full
+    def check_capacity(self, node=None):
+        if self.msg_q.qsize() >= MAX_QUEUE_DEPTH:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+
+        if node is not None and self.node_queued[node] >= MAX_NODE_QUEUE_DEPTH:
+            self.rejected_node += 1
+            raise QueueFull(self.retry_after())
+
+    # True if nothing is waiting to be sent
+    def idle(self):
+        return self.msg_q.empty()
+
+    # Estimated time (whole seconds) to send the queued messages, from
+    # the nodes' predicted latency or the average transmit time
+    def retry_after(self):
+        total = 0
+        for _, _, msg in list(self.msg_q.queue):
+            latency = self.topology.latency(msg.node) if msg.node is not None else None
+            total += max(latency or 0, self.tx_time)
+        return max(1, math.ceil(total))
+
+    def queue_status(self):
+        return {'depth': self.msg_q.qsize(),
+                'max_depth': MAX_QUEUE_DEPTH,
+                'node_depth': {n: c for n, c in self.node_queued.items() if c},
+                'max_node_depth': MAX_NODE_QUEUE_DEPTH,
+                'tx_time': self.tx_time,
+                'rejected': self.rejected,
+                'rejected_node': self.rejected_node,
+                'expired': self.expired,
+                'coalesced': self.coalesced,
+                'rx_depth': self.rx_q.qsize(),
+                'rx_dropped': self.rx_dropped,
+                'rx_collisions': self.rx_collisions}
+
+    # Sizes of internal tables, for memory monitoring
+    def table_sizes(self):
+        return {'msg_q': self.msg_q.qsize(),
+                'rx_q': self.rx_q.qsize(),
+                'node_queued': len(self.node_queued),
+                'coalesce': len(self.coalesce),
+                'tx_result': len(self.tx_result),
+                'func_result': len(self.func_result),
+                'routes': len(self.routes.nodes),
+                'topology': len(self.topology.neighbours),
+                'subscriptions': len(self.events.subscriptions),
+                'event_queue': self.events.status()['queued']}
 
     #-------------------------------------------------------------------
     # Internal functions
 
-    def transmit(self):
+    # Read neighbour tables once the stick is ready, then periodically
+    def maintain_topology(self):
         while 1:
-            msg = self.msg_q.get()
+            self.link_ready.wait()
+            try:
+                self.refresh_topology()
+            except (TransmitError, Timeout) as e:
+                logging.warning("Topology refresh failed: %s" % repr(e))
+                gevent.sleep(TOPOLOGY_RETRY)
+                continue
 
-            # Increment and wrap message ID
-            self.txmsg_id += 1
-            if self.txmsg_id > MAX_TXMSG_ID:
-                self.txmsg_id = MIN_TXMSG_ID
+            gevent.sleep(TOPOLOGY_REFRESH)
 
-            # tx_result is set by acknowledgement from remote node
-            tx_result = AsyncResult()
-            self.tx_result[self.txmsg_id] = tx_result
+    # Reopen serial link after failure, keeping queued messages
+    def supervise(self):
+        delay = REOPEN_DELAY
+        while 1:
+            if not self.link_open.is_set():
+                try:
+                    self.ser = open_transport(self.dev)
+                except (serial.SerialException, OSError) as e:
+                    logging.warning("Serial reopen failed: %s" % str(e))
+                    gevent.sleep(delay)
+                    delay = min(delay * 2, MAX_REOPEN_DELAY)
+                    continue
+
+                logging.warning("Serial link reopened")
+                self.reconnects += 1
+                self.link_failed.clear()
+                self.link_open.set()
+
+            # Handshake, check stick is responding
+            try:
+                self.version = self.get_version()[0]
+            except (TransmitError, Timeout) as e:
+                self.fail_link("Handshake failed, %s" % str(e))
+                gevent.sleep(delay)
+                delay = min(delay * 2, MAX_REOPEN_DELAY)
+                continue
+
+            logging.info("Z-Wave stick ready: %s" % self.version)
+            delay = REOPEN_DELAY
+            self.link_error = None
+            self.ready_time = time.time()
+            self.link_ready.set()
+
+            self.link_failed.wait()
+
+    # Close dead serial link, the supervisor will reopen it
+    def fail_link(self, reason):
+        if not self.link_open.is_set():
+            return
 
-            # Send message and wait for ACK/NAK/CAN from Z-Wave interface
-            ack = self.transmit_msg(msg, self.txmsg_id)
+        logging.error("Serial link failed: %s" % reason)
+        self.link_error = reason
+        self.link_ready.clear()
+        self.link_open.clear()
+        self.link_failed.set()
 
-            if ack in [zwave.CAN, zwave.NAK]:
-                # Re-try send message
-                for n in range(MAX_TX_RETRIES):
-                    gevent.sleep(0.1 + n)
-                    logging.debug("Tx retry #%d..." % (n + 1))
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
 
-                    ack = self.transmit_msg(msg, self.txmsg_id)
-                    if ack == zwave.ACK:
-                        break
+    def transmit(self):
+        while 1:
+            _, _, msg = self.msg_q.get()
+            self.link_ready.wait()
+            if msg.node is not None:
+                self.node_queued[msg.node] -= 1
+            if msg.key is not None:
+                self.coalesce.pop(msg.key, None)
+
+            # Wait for radio frame budget, then drop message if stale
+            gevent.sleep(self.frame_budget.delay())
+            start = time.monotonic()
+            if msg.expired(start):
+                self.expire(msg)
+                self.journal_tx(msg, None)
+                continue
+
+            if msg.trace:
+                msg.trace.add("queue", msg.queued, start)
+
+            with self.tx_lock:
+                if msg.node is None:
+                    # Controller request
+                    self.route_msg(msg, None, 0)
                 else:
-                    # Too many retries, give up on this message
-                    logging.error("Maximum Tx retries exceeded")
+                    # Escalate transmit options until delivered
+                    level = self.routes.level(msg.node)
+                    while not self.route_msg(msg, msg.node, level) and \
+                            level < self.routes.max_level():
+                        level += 1
+                        logging.warning("Tx escalating node %d to options %02x" %
+                                (msg.node, self.routes.options(level)))
+
+                    # Unless requeued after link failure
+                    if msg.result.ready():
+                        self.journal_tx(msg, time.monotonic() - start)
+
+            # Update measured drain rate
+            self.tx_time += TX_TIME_ALPHA * (time.monotonic() - start - self.tx_time)
+
+    # Put message back ahead of others of its priority, after the link
+    # failed while sending it. A newer message with the same key queued
+    # meanwhile is sent after it
+    def requeue(self, msg):
+        logging.warning("Tx requeued: %s" % zwave.msg_str(msg.data))
+        if msg.node is not None:
+            self.node_queued[msg.node] += 1
+        if msg.key is not None:
+            self.coalesce.setdefault(msg.key, msg)
+        self.msg_q.put((msg.priority, -next(self.msg_seq), msg))
+
+    def expire(self, msg):
+        logging.warning("Tx message expired: %s" % zwave.msg_str(msg.data))
+        self.expired += 1
+        msg.result.set_exception(Expired())
+
+    # Record message and its outcome in the node's journal
+    def journal_tx(self, msg, latency):
+        node = self.nodes.get(msg.node)
+        if node is None:
+            return
 
-            if ack == zwave.ACK:
-                try:
-                    # Wait for acknowledgement from remote node
-                    tx_result.get(timeout=TX_TIMEOUT)
-                except gevent.Timeout:
-                    logging.error("Tx timeout, no remote ACK")
+        try:
+            outcome = msg.result.get(block=False)
+        except TransmitError as e:
+            outcome = e.value
+        except Timeout:
+            outcome = OUTCOME_TIMEOUT
+        except Expired:
+            outcome = OUTCOME_EXPIRED
+        except Exception:
+            outcome = OUTCOME_ERROR
+
+        node.journal.record_tx(msg.data, outcome, msg.attempts,
+                               math.nan if latency is None else latency,
+                               node.default_endpoint)
+
+    # Deliver message using transmit options for level, recording the
+    # outcome. Returns False if delivery failed and is worth retrying,
+    # which it isn't once the message has expired or been cancelled.
+    # Messages in flight when the link fails are requeued
+    def route_msg(self, msg, node, level):
+        sent = time.monotonic()
+        try:
+            status = self.deliver(msg, self.routes.options(level))
+        except (TransmitError, Timeout) as e:
+            status = e
+
+        delivered = status == zwave.TRANSMIT_COMPLETE_OK
+
+        if not delivered and not self.link_ready.is_set() and \
+                not msg.expired(time.monotonic()):
+            self.requeue(msg)
+            return True
+
+        if isinstance(status, TransmitError):
+            # Failed at stick, routing won't help
+            msg.result.set_exception(status)
+            return True
+
+        # Caller giving up isn't a routing failure
+        if node is not None and (delivered or not msg.cancelled()):
+            self.routes.record(node, level, delivered, time.monotonic() - sent)
+
+        if delivered or node is None or level == self.routes.max_level():
+            if isinstance(status, Exception):
+                msg.result.set_exception(status)
+            else:
+                msg.result.set(status)
+            return True
+        elif msg.expired(time.monotonic()):
+            self.expire(msg)
+            return True
+        else:
+            return False
+
+    # Send message with transmit options and return transmit status from
+    # the remote node. Raises TransmitError if the Z-Wave interface
+    # doesn't accept the message, or Timeout if no status is received
+    def deliver(self, msg, options):
+        # Increment and wrap message ID
+        self.txmsg_id += 1
+        if self.txmsg_id > MAX_TXMSG_ID:
+            self.txmsg_id = MIN_TXMSG_ID
+        msg_id = self.txmsg_id
+
+        # tx_result is set by acknowledgement from remote node
+        tx_result = AsyncResult()
+        self.tx_result[msg_id] = tx_result
+
+        try:
+            return self.deliver_msg(msg, options, msg_id, tx_result)
+        finally:
+            # Remove result unless message ID has been reused
+            if self.tx_result.get(msg_id) is tx_result:
+                del self.tx_result[msg_id]
+
+    def deliver_msg(self, msg, options, msg_id, tx_result):
+        # Send message and wait for ACK/NAK/CAN from Z-Wave interface
+        start = time.monotonic()
+        data = msg.data + [options, msg_id]
+
+        # Only frames the stick accepts use the radio, retries after CAN
+        # or NAK aren't charged
+        self.frame_budget.take()
+        msg.attempts += 1
+        ack = self.transmit_msg(data)
+
+        if ack in [zwave.CAN, zwave.NAK]:
+            # Re-try send message
+            for n in range(MAX_TX_RETRIES):
+                gevent.sleep(0.1 + n)
+                logging.debug("Tx retry #%d..." % (n + 1))
+
+                msg.attempts += 1
+                ack = self.transmit_msg(data)
+                if ack == zwave.ACK:
+                    break
             else:
-                logging.error("Tx ACK not received")
+                # Too many retries, give up on this message
+                logging.error("Maximum Tx retries exceeded")
+
+        acked = time.monotonic()
+        if msg.trace:
+            msg.trace.add("ack", start, acked)
+
+        if ack != zwave.ACK:
+            logging.error("Tx ACK not received")
+            raise TransmitError(zwave.TRANSMIT_COMPLETE_FAIL)
+
+        try:
+            # Wait for acknowledgement from remote node
+            return tx_result.get(timeout=self.topology.timeout(msg.node, TX_TIMEOUT))
+        except gevent.Timeout:
+            logging.error("Tx timeout, no remote ACK")
+            raise Timeout()
+        finally:
+            if msg.trace:
+                msg.trace.add("callback", acked, time.monotonic())
 
     # Send message and wait for ACK/NAK/CAN from Z-Wave controller
-    def transmit_msg(self, msg, msg_id):
-        payload = [len(msg) + 3] + msg + [zwave.TRANSMIT_OPTION_ACK, msg_id]
-        buf = bytes([zwave.SOF] + payload + [zwave.checksum(payload)])
+    def transmit_msg(self, msg):
+        buf = frame(msg)
         logging.debug("Tx: " + zwave.msg_str(buf[1:]))
 
         self.ack_result = AsyncResult()
-        self.ser.write(buf)
         try:
+            self.ser.write(buf)
             result = self.ack_result.get(timeout=ACK_TIMEOUT)
+        except (serial.SerialException, OSError) as e:
+            self.fail_link("Write error, %s" % str(e))
+            result = None
         except gevent.Timeout:
             logging.warning("Tx ACK timeout")
             result = None
 
+            self.ack_timeouts += 1
+            if self.ack_timeouts >= MAX_ACK_TIMEOUTS:
+                self.fail_link("%d ACK timeouts" % self.ack_timeouts)
+        else:
+            self.ack_timeouts = 0
+
         self.ack_result = None
         return result
 
@@ -132,36 +629,43 @@ class Controller:
         logging.debug("Tx: ACK")
         self.ser.write([zwave.ACK])
 
-    def send_can(self):
-        logging.debug("Tx: CAN")
-        self.ser.write([zwave.CAN])
+    def send_nak(self):
+        logging.debug("Tx: NAK")
+        self.ser.write([zwave.NAK])
 
     def receive(self):
         while 1:
-            b = self.ser.read()
-            if not b:
-                continue
+            self.link_open.wait()
+            try:
+                self.receive_frame()
+            except (serial.SerialException, OSError) as e:
+                self.fail_link("Read error, %s" % str(e))
 
-            frame_type = b[0]
-            if frame_type == zwave.SOF:
-                # Data frame
-                self.read_msg()
+    def receive_frame(self):
+        b = self.ser.read()
+        if not b:
+            return
 
-            elif frame_type in [zwave.ACK, zwave.NAK, zwave.CAN]:
-                # ACK/NAK/CAN frame
-                logging.debug("Rx: %s" % ACK_STR[frame_type])
+        frame_type = b[0]
+        if frame_type == zwave.SOF:
+            # Data frame
+            self.read_msg()
 
-                if self.ack_result is not None:
-                    # Return result to t/x thread
-                    self.ack_result.set(frame_type)
-                else:
-                    # Unexpected ACK/NAK/CAN
-                    logging.warning("Rx unexpected %s" % ACK_STR[frame_type])
+        elif frame_type in [zwave.ACK, zwave.NAK, zwave.CAN]:
+            # ACK/NAK/CAN frame
+            logging.debug("Rx: %s" % ACK_STR[frame_type])
 
+            if self.ack_result is not None:
+                # Return result to t/x thread
+                self.ack_result.set(frame_type)
             else:
-                # Unknown frame
-                logging.warning(
-                        "Rx unexpected start character {0x:02x}".format(frame_type))
+                # Unexpected ACK/NAK/CAN
+                logging.warning("Rx unexpected %s" % ACK_STR[frame_type])
+
+        else:
+            # Unknown frame
+            logging.warning(
+                    "Rx unexpected start character {:02x}".format(frame_type))
 
     def read_msg(self):
         # Get message length
@@ -178,16 +682,35 @@ class Controller:
                 # Message length mismatch
                 logging.warning(
                     "Rx message length mismatach {}/{}".format(len(msg), msg_len))
+            elif zwave.checksum(b + msg[:-1]) != msg[-1]:
+                logging.warning("Rx checksum error: " + zwave.msg_str(msg))
+                self.send_nak()
             else:
                 logging.debug("Rx: " + zwave.msg_str(msg))
 
-                # Message acknowledgement
-                if self.ack_result is None:
-                    self.send_ack()
-                    self.process_msg(msg)
-                else:
-                    # Tx in progress, cancel receive
-                    self.send_can()
+                # Acknowledge now, process later
+                self.send_ack()
+                try:
+                    self.rx_q.put_nowait(msg)
+                except Full:
+                    logging.error("Rx queue full, message dropped")
+                    self.rx_dropped += 1
+
+                # Frame from stick while still waiting for ACK means it
+                # dropped ours, have transmitter send it again. A frame
+                # following the ACK isn't a collision
+                if self.ack_result is not None and not self.ack_result.ready():
+                    logging.debug("Tx collision")
+                    self.rx_collisions += 1
+                    self.ack_result.set(zwave.CAN)
+
+    def dispatch(self):
+        while 1:
+            msg = self.rx_q.get()
+            try:
+                self.process_msg(msg)
+            except Exception:
+                logging.exception("Rx processing failed: " + zwave.msg_str(msg))
 
     def process_msg(self, msg):
         if msg[0] == zwave.RESPONSE:
@@ -211,3 +734,9 @@ class Controller:
                     tx_result.set(result)
                 else:
                     logging.error("Unexpected tx acknowledgment")
+
+        # Response to function request
+        elif msg[0] == zwave.REQUEST:
+            result = self.func_result.get(msg[1])
+            if result:
+                result.set(msg[2:-1])
@@ -1,12 +1,17 @@
 from gevent import Timeout
 from gevent.event import AsyncResult
 import logging
+import time
 
 from . import command
+from . import trace
+from .controller import PRIORITY_NORMAL, wait_report
 
 TIMEOUT = 2.0
 
 class Endpoint:
+    REPORT = command.BasicReport
+
     def __init__(self, node, endpoint=1, name=""):
         self.node = node
         self.endpoint = endpoint
@@ -16,57 +21,98 @@ class Endpoint:
 
         self.async_value = AsyncResult()
 
-    def send_command(self, cmd):
-        return self.node.send_endpoint_command(self, cmd)
+        # Time of last report, by command class
+        self.last_report = {}
+
+    def send_command(self, cmd, priority=PRIORITY_NORMAL, timeout=None):
+        return self.node.send_endpoint_command(self, cmd, priority, timeout)
+
+    # Time to wait for a report, longer for slow nodes
+    def timeout(self):
+        return self.node.controller.topology.timeout(self.node.id, TIMEOUT)
+
+    # Subscribe to commands from this endpoint
+    def subscribe(self, callback, command_class=None):
+        return self.node.subscribe(callback, command_class, self.endpoint)
 
     def response(self, cmd):
         if isinstance(cmd, command.BasicReport):
             self.value = cmd.value
 
-    def set(self, value):
-        return self.send_command(command.BasicSet(value))
+    def set(self, value, timeout=None):
+        return self.send_command(command.BasicSet(value), timeout=timeout)
+
+    def get(self, priority=PRIORITY_NORMAL):
+        return self.send_command(command.BasicGet(), priority)
 
-    def get(self):
-        return self.send_command(command.BasicGet())
+    # Request meter report (handled asynchronously)
+    def get_meter(self, priority=PRIORITY_NORMAL):
+        return self.send_command(command.MeterGet(), priority)
 
 class BinarySwitch(Endpoint):
-    def get(self):
+    REPORT = command.BinarySwitchReport
+
+    def get(self, priority=PRIORITY_NORMAL):
         self.async_value = AsyncResult()
-        self.send_command(command.BinarySwitchGet())
+        msg = self.send_command(command.BinarySwitchGet(), priority, TIMEOUT)
 
         try:
-            result = self.async_value.get(timeout=TIMEOUT)
+            result = wait_report(self.async_value, msg, self.timeout())
         except Timeout:
+            msg.cancel()
             logging.error("BasicSwitch get timeout: %s" % self.name)
             result = None
+        else:
+            t = trace.current()
+            if t:
+                t.add("report", t.end, time.monotonic())
 
         return result
 
-    def set(self, value):
-        return self.send_command(command.BinarySwitchSet(value))
+    def set(self, value, timeout=None):
+        return self.send_command(command.BinarySwitchSet(value), timeout=timeout)
 
     def response(self, cmd):
         if isinstance(cmd, command.BinarySwitchReport):
-            print("response")
             self.async_value.set(cmd.value)
         else:
             super().response(cmd)
 
 class MultilevelSwitch(Endpoint):
-    def get(self):
+    REPORT = command.MultilevelSwitchReport
+
+    def get(self, priority=PRIORITY_NORMAL):
         self.async_value = AsyncResult()
-        self.send_command(command.MultilevelSwitchGet())
+        msg = self.send_command(command.MultilevelSwitchGet(), priority, TIMEOUT)
 
         try:
-            result = self.async_value.get(timeout=TIMEOUT)
+            result = wait_report(self.async_value, msg, self.timeout())
         except Timeout:
+            msg.cancel()
             logging.error("MultilevelSwitch get timeout: %s" % self.name)
             result = None
+        else:
+            t = trace.current()
+            if t:
+                t.add("report", t.end, time.monotonic())
 
         return result
 
-    def set(self, value):
-        return self.send_command(command.MultilevelSwitchSet(value))
+    # Set level, over duration seconds if given
+    def set(self, value, timeout=None, duration=None):
+        return self.send_command(command.MultilevelSwitchSet(value, duration),
+                                 timeout=timeout)
+
+    # Start dimming, for press and hold control
+    def start_level_change(self, up=True, start_level=None, duration=None,
+                           timeout=None):
+        return self.send_command(
+                command.MultilevelSwitchStartLevelChange(up, start_level, duration),
+                timeout=timeout)
+
+    def stop_level_change(self, timeout=None):
+        return self.send_command(command.MultilevelSwitchStopLevelChange(),
+                                 timeout=timeout)
 
     def response(self, cmd):
         if isinstance(cmd, command.MultilevelSwitchReport):
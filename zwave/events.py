@@ -0,0 +1,80 @@
+import logging
+
+from gevent.pool import Pool
+from gevent.queue import Queue, Full
+
+# Maximum events waiting for each subscriber
+SUBSCRIPTION_QUEUE_SIZE = 100
+
+# Maximum number of subscriptions (one delivery greenlet each)
+MAX_SUBSCRIPTIONS = 100
+
+class Subscription:
+    def __init__(self, hub, callback, command_class=None, node=None,
+                 endpoint=None, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.hub = hub
+        self.callback = callback
+        self.command_class = command_class
+        self.node = node
+        self.endpoint = endpoint
+
+        self.queue = Queue(maxsize)
+        self.delivered = 0
+        self.overflow = 0
+
+    def matches(self, node, endpoint, cmd):
+        return (self.node is None or self.node == node) and \
+               (self.endpoint is None or self.endpoint == endpoint) and \
+               (self.command_class is None or self.command_class == cmd.CLASS)
+
+    def cancel(self):
+        self.hub.unsubscribe(self)
+
+# Fan out of received commands to subscribers. Publishing never waits,
+# if a subscriber's queue is full the event is dropped and counted
+class EventHub:
+    def __init__(self, max_subscriptions=MAX_SUBSCRIPTIONS):
+        self.subscriptions = []
+        self.pool = Pool(max_subscriptions)
+        self.overflow = 0
+
+    # Call callback(node, endpoint, cmd) for matching commands. Endpoint
+    # is None for node level commands
+    def subscribe(self, callback, command_class=None, node=None, endpoint=None,
+                  maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        if self.pool.full():
+            raise ValueError("Too many subscriptions")
+
+        sub = Subscription(self, callback, command_class, node, endpoint, maxsize)
+        self.subscriptions.append(sub)
+        sub.greenlet = self.pool.spawn(self.deliver, sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub in self.subscriptions:
+            self.subscriptions.remove(sub)
+            sub.greenlet.kill(block=False)
+
+    def publish(self, node, endpoint, cmd):
+        for sub in self.subscriptions:
+            if sub.matches(node, endpoint, cmd):
+                try:
+                    sub.queue.put_nowait((node, endpoint, cmd))
+                except Full:
+                    sub.overflow += 1
+                    self.overflow += 1
+
+    def deliver(self, sub):
+        while 1:
+            event = sub.queue.get()
+            try:
+                sub.callback(*event)
+            except Exception:
+                logging.exception("Event subscriber failed")
+            sub.delivered += 1
+
+    def status(self):
+        return {'subscriptions': len(self.subscriptions),
+                'queued': sum(s.queue.qsize() for s in self.subscriptions),
+                'delivered': sum(s.delivered for s in self.subscriptions),
+                'overflow': self.overflow}
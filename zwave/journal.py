@@ -0,0 +1,111 @@
+import math
+import struct
+import time
+
+from . import zwave
+
+# Records kept per node
+JOURNAL_SIZE = 256
+
+# Fixed size record: time, type, endpoint, command class, command,
+# transmit outcome, attempts (frames sent, including retries and route
+# escalation), latency (seconds), first command value
+RECORD = struct.Struct("<dBBBBBBfi")
+
+EVENT_TX = 1
+EVENT_RX = 2
+
+EVENT_TYPES = {'tx': EVENT_TX, 'rx': EVENT_RX}
+EVENT_NAMES = {v: k for k, v in EVENT_TYPES.items()}
+
+# Outcomes other than the stick's transmit status codes
+OUTCOME_ERROR = 0xfc
+OUTCOME_EXPIRED = 0xfd
+OUTCOME_TIMEOUT = 0xfe
+
+NO_VALUE = -2**31
+
+# Ring buffer of node events, commands sent with their transmit outcome
+# and reports received. Records are packed into a preallocated buffer so
+# memory use doesn't grow with traffic
+class Journal:
+    def __init__(self, size=JOURNAL_SIZE):
+        self.size = size
+        self.buf = bytearray(RECORD.size * size)
+        self.next = 0
+        self.count = 0
+
+    def record(self, type, endpoint, command_class, command, outcome=0,
+               attempts=0, latency=math.nan, value=None):
+        RECORD.pack_into(self.buf, self.next * RECORD.size, time.time(), type,
+                         endpoint, command_class, command, outcome, attempts,
+                         latency, NO_VALUE if value is None else value)
+
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    # Send data message, data is the Serial API frame. Commands embedded
+    # in a Multi Command frame are recorded separately, endpoint(command
+    # class) gives the endpoint of commands without multi-channel
+    # encapsulation, as for received reports
+    def record_tx(self, data, outcome, attempts, latency, endpoint):
+        payload = list(data[4:4 + data[3]])
+
+        if payload[:2] == [zwave.COMMAND_CLASS_MULTI_CMD, zwave.MULTI_CMD_ENCAP]:
+            commands = []
+            n = 3
+            for i in range(payload[2]):
+                size = payload[n]
+                commands.append(payload[n+1:n+1+size])
+                n += size + 1
+        else:
+            commands = [payload]
+
+        for cmd in commands:
+            if cmd[:2] == [zwave.COMMAND_CLASS_MULTI_CHANNEL,
+                           zwave.MULTI_CHANNEL_CMD_ENCAP]:
+                ep, cmd = cmd[3], cmd[4:]
+            else:
+                ep = endpoint(cmd[0])
+
+            self.record(EVENT_TX, ep, cmd[0], cmd[1] if len(cmd) > 1 else 0,
+                        outcome, attempts, latency,
+                        cmd[2] if len(cmd) > 2 else None)
+
+    def record_rx(self, endpoint, cmd):
+        value = getattr(cmd, 'value', None)
+        if type(value) is not int:
+            value = None
+
+        self.record(EVENT_RX, endpoint or 0, cmd.CLASS, cmd.COMMAND, value=value)
+
+    # Records oldest first, filtered by time range and event types. With
+    # limit only the latest are returned
+    def query(self, since=None, until=None, types=None, limit=None):
+        events = []
+        start = (self.next - self.count) % self.size
+        for i in range(self.count):
+            (t, type, endpoint, command_class, command, outcome, attempts,
+             latency, value) = RECORD.unpack_from(
+                    self.buf, ((start + i) % self.size) * RECORD.size)
+
+            if (since is not None and t < since) or \
+               (until is not None and t > until) or \
+               (types is not None and type not in types):
+                continue
+
+            tx = type == EVENT_TX
+            events.append({
+                'time': t,
+                'type': EVENT_NAMES.get(type),
+                'endpoint': endpoint,
+                'command_class': command_class,
+                'command': command,
+                'outcome': outcome if tx else None,
+                'attempts': attempts if tx else None,
+                'latency': latency if tx and not math.isnan(latency) else None,
+                'value': None if value == NO_VALUE else value})
+
+        if limit is not None:
+            events = events[-limit:] if limit > 0 else []
+        return events
@@ -0,0 +1,121 @@
+import gc
+import logging
+import os
+import resource
+import tracemalloc
+
+import gevent
+from greenlet import greenlet
+
+# Number of allocation sites reported
+MEMORY_TOP_SITES = 10
+
+# Default number of stack frames recorded per allocation
+TRACEMALLOC_FRAMES = 1
+
+# Resident set size (bytes), from /proc where available
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+# Peak resident set size (bytes)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def greenlet_count():
+    return sum(1 for o in gc.get_objects() if isinstance(o, greenlet))
+
+# Start recording allocations, which slows the service and takes memory
+# of its own so is off until asked for
+def start_tracing(frames=TRACEMALLOC_FRAMES):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def stop_tracing():
+    tracemalloc.stop()
+
+# Top allocation sites, as {'site', 'size', 'count'} and with 'growth'
+# (bytes) if compared to an earlier snapshot
+def top_sites(snapshot, previous=None, limit=MEMORY_TOP_SITES):
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")])
+
+    if previous:
+        stats = snapshot.compare_to(previous, 'lineno')
+    else:
+        stats = snapshot.statistics('lineno')
+
+    sites = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        site = {'site': "%s:%d" % (frame.filename, frame.lineno),
+                'size': stat.size,
+                'count': stat.count}
+        if previous:
+            site['growth'] = stat.size_diff
+        sites.append(site)
+
+    return sites
+
+# Memory use, with internal table sizes from tables()
+def report(tables, limit=MEMORY_TOP_SITES):
+    status = {'rss': rss(),
+              'peak_rss': peak_rss(),
+              'greenlets': greenlet_count(),
+              'tables': tables(),
+              'tracing': tracemalloc.is_tracing()}
+
+    if tracemalloc.is_tracing():
+        status['traced'], status['traced_peak'] = tracemalloc.get_traced_memory()
+        status['top'] = top_sites(tracemalloc.take_snapshot(), limit=limit)
+
+    return status
+
+# Periodic leak report. Logs memory use and the allocation sites grown
+# most since the last report, and exits (for the service manager to
+# restart) if the resident set exceeds budget bytes
+class MemoryMonitor:
+    def __init__(self, tables, interval, budget=None):
+        self.tables = tables
+        self.interval = interval
+        self.budget = budget
+
+        self.snapshot = None
+        self.last_rss = None
+
+    def start(self):
+        gevent.spawn(self.run)
+
+    #-------------------------------------------------------------------
+    # Internal functions
+
+    def run(self):
+        while 1:
+            gevent.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        size = rss()
+        growth = size - self.last_rss if size and self.last_rss else 0
+        self.last_rss = size
+
+        logging.info("Memory: rss %s growth %d greenlets %d tables %s" % (
+            size, growth, greenlet_count(), self.tables()))
+
+        over = self.budget and size and size > self.budget
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            for site in top_sites(snapshot, self.snapshot):
+                if site.get('growth', 0) > 0 or over:
+                    logging.log(logging.ERROR if over else logging.INFO,
+                                "Memory site: %s" % site)
+            self.snapshot = snapshot
+
+        if over:
+            logging.critical("Memory budget exceeded: rss %d > %d" % (size, self.budget))
+            logging.shutdown()
+            os._exit(1)
@@ -1,12 +1,59 @@
+from gevent import Timeout
 from gevent.event import AsyncResult
+import gevent
 import logging
+import time
 
 from . import command
 from . import serialize
+from . import trace
 from . import zwave
+from .controller import Message, Expired, QueueFull, MAX_NODE_QUEUE_DEPTH, wait_report
+from .controller import PRIORITY_HIGH, PRIORITY_NORMAL
+from .journal import Journal
+
+# Time to wait for configuration and association reports
+CONFIG_TIMEOUT = 1.0
+ASSOCIATION_TIMEOUT = 1.0
+
+# Time a command may wait in a sleeping node's mailbox, unless a timeout
+# is given
+MAILBOX_TIMEOUT = 24 * 3600.0
+
+# Time (seconds) to collect commands for a multi command frame
+BATCH_WINDOW = 0.05
+
+# Multi command encapsulation overhead, class, command and count
+MULTI_CMD_HEADER = 3
+
+# Commands handled by the node rather than an endpoint
+NODE_COMMANDS = (command.ConfigurationReport, command.MultiChannelAssociationReport,
+                 command.MultiChannelAssociationGroupingsReport,
+                 command.WakeUpNotification)
+
+# Command classes handled by the node rather than an endpoint
+NODE_CLASSES = {c.CLASS for c in NODE_COMMANDS}
+
+# Commands where a queued value can be replaced by a newer one
+COALESCE_COMMANDS = (command.BasicSet, command.BinarySwitchSet,
+                     command.MultilevelSwitchSet, command.ConfigurationSet)
+
+# Nodes and multi-channel nodes to remove from and add to an association
+# group to get from current to desired, as (remove, add) with each a
+# (nodes, multi_channel_nodes) pair
+def association_diff(current, desired):
+    cur_nodes = set(current.get('nodes', []))
+    cur_mc = set(map(tuple, current.get('multi_channel_nodes', [])))
+    new_nodes = set(desired.get('nodes', []))
+    new_mc = set(map(tuple, desired.get('multi_channel_nodes', [])))
+
+    remove = (sorted(cur_nodes - new_nodes), sorted(cur_mc - new_mc))
+    add = (sorted(new_nodes - cur_nodes), sorted(new_mc - cur_mc))
+    return remove, add
 
 class Node:
-    def __init__(self, controller, id, name="Node", config=None):
+    def __init__(self, controller, id, name="Node", config=None,
+                 association_groups=None, sleeping=False, multi_command=False):
         self.controller = controller
         self.id = id
         self.name = name
@@ -16,8 +63,30 @@ class Node:
         else:
             self.config = config
         self.config_result = {}
+        self.config_reported = {}
 
         self.multi_channel_association_result = {}
+        self.multi_channel_association_reports = {}
+        self.groupings_result = None
+
+        # Association table cache, group: association
+        self.association_groups = association_groups
+        self.associations = {}
+
+        # Battery powered nodes only listen after a wake up notification,
+        # commands are held in the mailbox until then
+        self.sleeping = sleeping
+        self.awake = False
+        self.mailbox = {}
+        self.mailbox_seq = 0
+
+        # Nodes supporting multi command encapsulation get commands sent
+        # close together in a single frame
+        self.multi_command = multi_command
+        self.batch = []
+
+        # Recent commands sent and reports received
+        self.journal = Journal()
 
         controller.register_node(self)
         self.endpoints = {}
@@ -25,17 +94,139 @@ class Node:
     def register_endpoint(self, endpoint):
         self.endpoints[endpoint.endpoint] = endpoint
 
-    def send_command(self, cmd):
+    # Sizes of internal tables, for memory monitoring
+    def table_sizes(self):
+        return {'config_result': len(self.config_result),
+                'config_reported': len(self.config_reported),
+                'multi_channel_association_result': len(self.multi_channel_association_result),
+                'multi_channel_association_reports': len(self.multi_channel_association_reports),
+                'associations': len(self.associations),
+                'mailbox': len(self.mailbox),
+                'batch': len(self.batch),
+                'journal': self.journal.count}
+
+    def send_command(self, cmd, priority=PRIORITY_NORMAL, timeout=None):
         cmd_frame = serialize.serialize(cmd)
         msg_data = [self.id, len(cmd_frame)] + cmd_frame
-        self.controller.send_data(msg_data)
+        key = self.coalesce_key(cmd)
+
+        if self.sleeping and not self.awake:
+            return self.post_mailbox(msg_data, priority, timeout, key)
+        elif self.multi_command:
+            return self.add_batch(cmd, msg_data, priority, timeout, key)
+        else:
+            return self.controller.send_data(msg_data, priority, timeout, key)
+
+    # Add command to batch, which is sent after the batch window. Raises
+    # QueueFull if the transmit queue has no room for the node
+    def add_batch(self, cmd, msg_data, priority, timeout, key):
+        msg = Message([zwave.REQUEST, zwave.API_ZW_SEND_DATA] + msg_data,
+                      priority, self.id, timeout, key)
+
+        # Newer set replaces a batched one
+        for i, (_, batched) in enumerate(self.batch):
+            if key is not None and batched.key == key:
+                batched.data = msg.data
+                batched.deadline = max(batched.deadline, msg.deadline)
+                self.batch[i] = (cmd, batched)
+                return batched
+
+        self.controller.check_capacity(self.id)
+
+        if not self.batch:
+            gevent.spawn_later(BATCH_WINDOW, self.send_batch)
+        self.batch.append((cmd, msg))
+        return msg
+
+    # Send batched commands, packing as many as fit in each frame
+    def send_batch(self):
+        batch, self.batch = self.batch, []
+
+        now = time.monotonic()
+        frames = []
+        size = zwave.MAX_PAYLOAD
+        for cmd, msg in batch:
+            if msg.expired(now):
+                msg.result.set_exception(Expired())
+                continue
+
+            cmd_size = len(msg.data) - 4 + 1
+            if size + cmd_size > zwave.MAX_PAYLOAD:
+                frames.append([])
+                size = MULTI_CMD_HEADER
+            frames[-1].append((cmd, msg))
+            size += cmd_size
+
+        for parts in frames:
+            try:
+                if len(parts) == 1:
+                    msg = parts[0][1]
+                    queued = self.controller.queue_msg(msg)
+                    if queued is not msg:
+                        # Coalesced into a queued message, share its result
+                        self.share_result(queued, [msg])
+                else:
+                    self.send_multi_command(parts)
+            except QueueFull as e:
+                for _, msg in parts:
+                    msg.result.set_exception(e)
+
+    def send_multi_command(self, parts):
+        cmd_frame = serialize.serialize(
+                command.MultiCommandEncap([cmd for cmd, _ in parts]))
 
-    def send_endpoint_command(self, endpoint, cmd):
+        msgs = [msg for _, msg in parts]
+        msg = Message([zwave.REQUEST, zwave.API_ZW_SEND_DATA, self.id,
+                       len(cmd_frame)] + cmd_frame,
+                      min(m.priority for m in msgs), self.id)
+        msg.deadline = max(m.deadline for m in msgs)
+        msg.trace = msgs[0].trace
+
+        self.share_result(msg, msgs)
+        self.controller.queue_msg(msg)
+
+    # Set result of msgs to the transmit result of msg
+    def share_result(self, msg, msgs):
+        def set_results(result):
+            for m in msgs:
+                if result.successful():
+                    m.result.set(result.value)
+                else:
+                    m.result.set_exception(result.exception)
+
+        msg.result.rawlink(set_results)
+
+    # Key identifying set commands which supersede each other
+    def coalesce_key(self, cmd):
+        endpoint = 0
+        if type(cmd) is command.MultiChannelEncap:
+            endpoint, cmd = cmd.endpoint, cmd.command
+
+        if type(cmd) is command.ConfigurationSet:
+            return (self.id, endpoint, cmd.CLASS, cmd.parameter)
+        elif type(cmd) in COALESCE_COMMANDS:
+            return (self.id, endpoint, cmd.CLASS)
+        else:
+            return None
+
+    def send_endpoint_command(self, endpoint, cmd, priority=PRIORITY_NORMAL,
+                              timeout=None):
         if len(self.endpoints) > 1:
             cmd = command.MultiChannelEncap(endpoint.endpoint, cmd)
-            self.send_command(cmd)
+            return self.send_command(cmd, priority, timeout)
         else:
-            self.send_command(cmd)
+            return self.send_command(cmd, priority, timeout)
+
+    # Subscribe to commands from this node
+    def subscribe(self, callback, command_class=None, endpoint=None):
+        return self.controller.subscribe(callback, command_class, self.id, endpoint)
+
+    # Pass report to endpoint, noting when it arrived
+    def endpoint_response(self, endpoint, cmd):
+        endpoint.last_report[cmd.CLASS] = time.monotonic()
+        endpoint.response(cmd)
+        self.journal.record_rx(endpoint.endpoint, cmd)
+        self.controller.events.publish(self.id, endpoint.endpoint, cmd)
 
     def response(self, data):
         try:
@@ -45,26 +236,118 @@ class Node:
             logging.warning("%s: Can't deserialize %s" % (self.name, zwave.msg_str(data)))
             return
 
+        self.command_response(cmd)
+
+    def command_response(self, cmd):
+        if type(cmd) is command.MultiCommandEncap:
+            for c in cmd.commands:
+                self.command_response(c)
+
+        elif type(cmd) is command.MultiChannelEncap:
+            if self.endpoints.get(cmd.endpoint):
+                self.endpoint_response(self.endpoints[cmd.endpoint], cmd.command)
+            else:
+                logging.warning("Unknown endpoint: %s" % cmd)
+
+        elif type(cmd) not in NODE_COMMANDS and self.endpoints.get(1):
+            self.endpoint_response(self.endpoints[1], cmd)
+
+        else:
+            self.node_response(cmd)
+
+    # Endpoint of a command without multi-channel encapsulation, 0 for
+    # the node itself
+    def default_endpoint(self, command_class):
+        if command_class not in NODE_CLASSES and self.endpoints.get(1):
+            return 1
+        else:
+            return 0
+
+    def node_response(self, cmd):
+        self.journal.record_rx(None, cmd)
+        self.controller.events.publish(self.id, None, cmd)
+
         if type(cmd) is command.ConfigurationReport:
             self.configuration_response(cmd)
 
         elif type(cmd) is command.MultiChannelAssociationReport:
             self.multi_channel_association_response(cmd)
 
-        elif type(cmd) is command.MultiChannelEncap:
-            if self.endpoints.get(cmd.endpoint):
-                self.endpoints[cmd.endpoint].response(cmd.command)
-            else:
-                logging.warning("Unknown endpoint: %s" % zwave.msg_str(data))
+        elif type(cmd) is command.MultiChannelAssociationGroupingsReport:
+            self.groupings_response(cmd)
 
-        elif self.endpoints.get(1):
-            self.endpoints[1].response(cmd)
+        elif type(cmd) is command.WakeUpNotification:
+            self.wake_up()
 
         else:
-            logging.warning("Unhandled response: %s" % zwave.msg_str(data))
+            logging.warning("Unhandled response: %s" % cmd)
+
+    # Mailbox for sleeping node
+    def post_mailbox(self, msg_data, priority, timeout, key):
+        if timeout is None:
+            timeout = MAILBOX_TIMEOUT
+
+        msg = Message([zwave.REQUEST, zwave.API_ZW_SEND_DATA] + msg_data,
+                      priority, self.id, timeout, key)
+
+        # Newer set replaces a held one
+        if key is not None and key in self.mailbox:
+            held = self.mailbox[key]
+            held.data = msg.data
+            held.deadline = max(held.deadline, msg.deadline)
+            return held
+
+        # Drop held commands which have expired, and hold no more than the
+        # node's share of the transmit queue
+        now = time.monotonic()
+        for k, held in list(self.mailbox.items()):
+            if held.expired(now):
+                logging.warning("%s: Mailbox expired %s" % (self.name, zwave.msg_str(held.data)))
+                held.result.set_exception(Expired())
+                del self.mailbox[k]
+
+        if len(self.mailbox) >= MAX_NODE_QUEUE_DEPTH:
+            self.controller.rejected_node += 1
+            raise QueueFull(self.controller.retry_after())
+
+        if key is None:
+            self.mailbox_seq += 1
+            key = self.mailbox_seq
+
+        logging.debug("%s: Mailbox %s" % (self.name, zwave.msg_str(msg.data)))
+        self.mailbox[key] = msg
+        return msg
+
+    # Node is listening, send held commands then let it sleep again
+    def wake_up(self):
+        if not self.sleeping:
+            logging.info("%s: Wake up notification, node is sleeping" % self.name)
+            self.sleeping = True
+
+        now = time.monotonic()
+        for key, msg in list(self.mailbox.items()):
+            if msg.expired(now):
+                msg.result.set_exception(Expired())
+            else:
+                msg.priority = PRIORITY_HIGH
+                try:
+                    self.controller.queue_msg(msg)
+                except QueueFull:
+                    logging.warning("%s: Queue full, mailbox held" % self.name)
+                    break
+
+            del self.mailbox[key]
+
+        self.awake = True
+        try:
+            self.send_command(command.WakeUpNoMoreInformation(), PRIORITY_HIGH)
+        except QueueFull:
+            logging.warning("%s: Queue full, no more information not sent" % self.name)
+        finally:
+            self.awake = False
 
     # Configuration
-    def set_configuration(self, parameter, value, format=None):
+    def set_configuration(self, parameter, value, format=None, timeout=None):
         config = self.config.get(parameter)
 
         if config:
@@ -76,27 +359,50 @@ class Node:
             logging.warning("Unknown parameter %s" % str(parameter))
             return False
 
-        self.send_command(command.ConfigurationSet(addr, value, format))
+        self.send_command(command.ConfigurationSet(addr, value, format),
+                          timeout=timeout)
         return True
 
-    def get_configuration(self, parameter):
-        config = self.config.get(parameter)
-        if config:
-            addr = config['address']
-        elif type(parameter) is int:
-            addr = parameter
-        else:
+    def get_configuration(self, parameter, priority=PRIORITY_NORMAL):
+        addr = self.config_address(parameter)
+        if addr is None:
             logging.warning("Unknown parameter %s" % str(parameter))
             return None
 
         async_res = AsyncResult()
         self.config_result[addr] = async_res
-        self.send_command(command.ConfigurationGet(addr))
+        msg = self.send_command(command.ConfigurationGet(addr), priority,
+                                CONFIG_TIMEOUT)
+
+        try:
+            result = wait_report(async_res, msg,
+                    self.controller.topology.timeout(self.id, CONFIG_TIMEOUT))
+        except Timeout:
+            msg.cancel()
+            raise
+        finally:
+            if self.config_result.get(addr) is async_res:
+                del self.config_result[addr]
+
+        t = trace.current()
+        if t:
+            t.add("report", t.end, time.monotonic())
 
-        result = async_res.get(timeout=1.0)
         return result
 
+    # Parameter address from name (or integer address)
+    def config_address(self, parameter):
+        config = self.config.get(parameter)
+        if config:
+            return config['address']
+        elif type(parameter) is int:
+            return parameter
+        else:
+            return None
+
     def configuration_response(self, cmd):
+        self.config_reported[cmd.parameter] = time.monotonic()
+
         result = self.config_result.get(cmd.parameter)
         if  result:
             result.set(cmd.value)
@@ -109,21 +415,109 @@ class Node:
 
     # Multi-channel association
     def multi_channel_association_response(self, cmd):
-        self.multi_channel_association_result[cmd.group].set(
-                {'nodes': cmd.nodes,
-                 'multi_channel_nodes': cmd.multi_channel_nodes})
+        result = self.multi_channel_association_result.get(cmd.group)
+        if result is None:
+            logging.warning("Unexpected multi-channel association response")
+            return
 
-    def get_multi_channel_association(self, group):
+        # Large groups are split over several reports, num_reports is the
+        # number still to follow
+        reports = self.multi_channel_association_reports.setdefault(cmd.group, [])
+        reports.append(cmd)
+        if cmd.num_reports > 0:
+            return
+
+        del self.multi_channel_association_reports[cmd.group]
+        association = {
+            'nodes': [n for r in reports for n in r.nodes],
+            'multi_channel_nodes': [list(n) for r in reports
+                                            for n in r.multi_channel_nodes]}
+
+        self.associations[cmd.group] = association
+        result.set(association)
+
+    def get_multi_channel_association(self, group, timeout=ASSOCIATION_TIMEOUT):
         async_res = AsyncResult()
         self.multi_channel_association_result[group] = async_res
+        self.multi_channel_association_reports.pop(group, None)
+
+        msg = self.send_command(command.MultiChannelAssociationGet(group),
+                                timeout=timeout)
 
-        self.send_command(command.MultiChannelAssociationGet(group))
+        try:
+            result = wait_report(async_res, msg, timeout)
+        except Timeout:
+            msg.cancel()
+            raise
+        finally:
+            if self.multi_channel_association_result.get(group) is async_res:
+                del self.multi_channel_association_result[group]
+                self.multi_channel_association_reports.pop(group, None)
 
-        result = async_res.get(timeout=1.0)
         return result
 
+    def groupings_response(self, cmd):
+        if self.groupings_result:
+            self.groupings_result.set(cmd.groupings)
+        else:
+            logging.warning("Unexpected association groupings response")
+
+    # Number of association groups, from configuration or the device
+    def get_association_groups(self):
+        if self.association_groups is None:
+            self.groupings_result = AsyncResult()
+            msg = self.send_command(command.MultiChannelAssociationGroupingsGet(),
+                                    timeout=ASSOCIATION_TIMEOUT)
+            try:
+                self.association_groups = wait_report(
+                        self.groupings_result, msg, ASSOCIATION_TIMEOUT)
+            except Timeout:
+                msg.cancel()
+                raise
+
+        return self.association_groups
+
+    # Complete association table, group: association. Groups are read
+    # concurrently, or taken from the cache unless refresh is set
+    def get_multi_channel_associations(self, refresh=False):
+        groups = range(1, self.get_association_groups() + 1)
+
+        missing = [g for g in groups if refresh or g not in self.associations]
+        if missing:
+            timeout = ASSOCIATION_TIMEOUT * len(missing)
+            jobs = [gevent.spawn(self.get_multi_channel_association, g, timeout)
+                    for g in missing]
+            gevent.joinall(jobs, raise_error=True)
+
+        return {g: self.associations[g] for g in groups}
+
+    # Update association table to match desired, group: association,
+    # sending only the necessary remove/set commands. Returns the changes
+    def update_multi_channel_associations(self, desired):
+        current = self.get_multi_channel_associations()
+
+        changes = {}
+        for group, assoc in desired.items():
+            remove, add = association_diff(current.get(group, {}), assoc)
+
+            if remove[0] or remove[1]:
+                self.remove_multi_channel_association(group, *remove)
+            if add[0] or add[1]:
+                self.set_multi_channel_association(group, *add)
+
+            if remove[0] or remove[1] or add[0] or add[1]:
+                changes[group] = {
+                    'remove': {'nodes': remove[0],
+                               'multi_channel_nodes': [list(n) for n in remove[1]]},
+                    'add': {'nodes': add[0],
+                            'multi_channel_nodes': [list(n) for n in add[1]]}}
+
+        return changes
+
     def remove_multi_channel_association(self, group, nodes, multi_channel_nodes):
+        self.associations.pop(group, None)
         self.send_command(command.MultiChannelAssociationRemove(group, nodes, multi_channel_nodes))
 
     def set_multi_channel_association(self, group, nodes, multi_channel_nodes):
+        self.associations.pop(group, None)
         self.send_command(command.MultiChannelAssociationSet(group, nodes, multi_channel_nodes))
@@ -0,0 +1,132 @@
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import gevent
+
+from .command import MeterReport
+from .controller import PRIORITY_LOW, QueueFull, TransmitError, Timeout, Expired
+from .ratelimit import TokenBucket
+
+# Default radio airtime budget for polling
+POLL_FRAMES_PER_MINUTE = 6
+
+# Random variation of poll interval, as fraction of interval
+POLL_JITTER = 0.1
+
+# Polls falling due within this time (seconds) are sent together
+POLL_BATCH_WINDOW = 5.0
+
+# Time (seconds) to wait for transmit queue to empty before polling
+POLL_IDLE_WAIT = 0.2
+
+class PollItem:
+    def __init__(self, name, interval, last_report, request):
+        self.name = name
+        self.interval = interval
+        self.last_report = last_report
+        self.request = request
+
+class Poller:
+    def __init__(self, controller, frames_per_minute=POLL_FRAMES_PER_MINUTE):
+        self.controller = controller
+        self.budget = TokenBucket(frames_per_minute / 60.0)
+
+        self.schedule = []
+        self.seq = itertools.count()
+
+        self.polls = 0
+        self.skipped = 0
+
+    # Add periodic poll. last_report() returns monotonic time of the
+    # latest report (or None) and request() sends the poll
+    def add(self, name, interval, last_report, request):
+        item = PollItem(name, interval, last_report, request)
+
+        # Spread initial polls over the first interval
+        self.queue(item, time.monotonic() + random.uniform(0, interval))
+
+    # Poll switch state
+    def add_state(self, endpoint, interval):
+        self.add("%s state" % endpoint.name, interval,
+                 lambda: endpoint.last_report.get(endpoint.REPORT.CLASS),
+                 lambda: endpoint.get(priority=PRIORITY_LOW))
+
+    # Poll endpoint meter
+    def add_meter(self, endpoint, interval):
+        self.add("%s meter" % endpoint.name, interval,
+                 lambda: endpoint.last_report.get(MeterReport.CLASS),
+                 lambda: endpoint.get_meter(priority=PRIORITY_LOW))
+
+    # Poll node configuration parameter
+    def add_configuration(self, node, parameter, interval):
+        addr = node.config_address(parameter)
+        if addr is None:
+            logging.warning("Unknown poll parameter %s" % str(parameter))
+            return
+
+        self.add("%s %s" % (node.name, parameter), interval,
+                 lambda: node.config_reported.get(addr),
+                 lambda: node.get_configuration(parameter, priority=PRIORITY_LOW))
+
+    def queue(self, item, due):
+        heapq.heappush(self.schedule, (due, next(self.seq), item))
+
+    def jitter(self, interval):
+        return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def start(self):
+        gevent.spawn(self.run)
+
+    #-------------------------------------------------------------------
+    # Internal functions
+
+    def run(self):
+        while 1:
+            if not self.schedule:
+                gevent.sleep(1.0)
+                continue
+
+            delay = self.schedule[0][0] - time.monotonic()
+            if delay > 0:
+                gevent.sleep(delay)
+
+            # Take all polls due in batch window
+            batch_end = time.monotonic() + POLL_BATCH_WINDOW
+            batch = []
+            while self.schedule and self.schedule[0][0] <= batch_end:
+                batch.append(heapq.heappop(self.schedule)[2])
+
+            for item in batch:
+                self.poll(item)
+
+    def poll(self, item):
+        now = time.monotonic()
+
+        # Skip poll if a report has arrived within the interval
+        last = item.last_report()
+        if last is not None and now - last < item.interval:
+            logging.debug("Poll skipped, fresh report: %s" % item.name)
+            self.skipped += 1
+            self.queue(item, last + self.jitter(item.interval))
+            return
+
+        # Keep within airtime budget and give way to other traffic
+        self.budget.take()
+        while not self.controller.idle():
+            gevent.sleep(POLL_IDLE_WAIT)
+
+        logging.debug("Poll: %s" % item.name)
+        self.polls += 1
+        try:
+            item.request()
+        except gevent.Timeout:
+            logging.warning("Poll timeout: %s" % item.name)
+        except QueueFull:
+            logging.warning("Poll dropped, queue full: %s" % item.name)
+        except (TransmitError, Timeout, Expired) as e:
+            logging.warning("Poll failed: %s %s" % (item.name, repr(e)))
+
+        self.queue(item, time.monotonic() + self.jitter(item.interval))
@@ -0,0 +1,38 @@
+import time
+
+import gevent
+
+# Token bucket, refilled at rate tokens/second up to burst tokens
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Time (seconds) until n tokens are available
+    def delay(self, n=1):
+        self.refill()
+        if self.tokens >= n:
+            return 0.0
+        else:
+            return (n - self.tokens) / self.rate
+
+    # Take n tokens if available, without waiting
+    def try_take(self, n=1):
+        if self.delay(n) == 0.0:
+            self.tokens -= n
+            return True
+        else:
+            return False
+
+    # Take n tokens, waiting until they are available
+    def take(self, n=1):
+        while not self.try_take(n):
+            gevent.sleep(self.delay(n))
@@ -0,0 +1,187 @@
+import logging
+import struct
+
+import gevent
+from gevent.pool import Pool
+
+from .controller import PRIORITY_LOW, TransmitError, Timeout, QueueFull, Expired
+from .node import association_diff
+from .ratelimit import TokenBucket
+
+# Default radio airtime budget for reconciling
+RECONCILE_FRAMES_PER_MINUTE = 120
+
+# Number of reads in flight
+RECONCILE_CONCURRENCY = 4
+
+# Time (seconds) allowed for writes to be sent before verifying
+RECONCILE_SETTLE = 1.0
+
+# Reported values are signed, compare with desired value in the same form
+def reported_value(value, fmt):
+    return struct.unpack(">" + fmt.lower(), struct.pack(">" + fmt, value))[0]
+
+# Bring node configuration parameters and association groups to the
+# values declared for them. desired is by node ID:
+#
+#   configuration: {parameter: value, ...}
+#   associations:  {group: {nodes: [...], multi_channel_nodes: [[node, endpoint], ...]}}
+#
+# Current values are read concurrently within the airtime budget, only
+# those which differ are written, then read back to verify
+class Reconciler:
+    def __init__(self, nodes, desired, frames_per_minute=RECONCILE_FRAMES_PER_MINUTE,
+                 concurrency=RECONCILE_CONCURRENCY):
+        self.nodes = nodes
+        self.desired = desired
+        self.budget = TokenBucket(frames_per_minute / 60.0, concurrency)
+        self.concurrency = concurrency
+
+    # Returns drift report by node. With dry_run nothing is written
+    def run(self, dry_run=False):
+        items = []
+        for node_id, desired in self.desired.items():
+            node = self.nodes[node_id]
+
+            for param, value in desired.get('configuration', {}).items():
+                items.append(ParameterItem(node_id, node, param, value))
+            for group, assoc in desired.get('associations', {}).items():
+                items.append(AssociationItem(node_id, node, group, assoc))
+
+        known = [i for i in items if i.status is None]
+
+        self.read_all(known)
+        drift = [i for i in known if not i.matches()]
+
+        if not dry_run and drift:
+            for item in drift:
+                self.budget.take()
+                try:
+                    item.write()
+                except QueueFull:
+                    logging.warning("Reconcile write dropped, queue full: %s" % item)
+                    item.status = 'failed'
+
+            gevent.sleep(RECONCILE_SETTLE)
+
+            written = [i for i in drift if i.status != 'failed']
+            self.read_all(written)
+            for item in written:
+                item.status = 'fixed' if item.matches() else 'failed'
+        else:
+            for item in drift:
+                item.status = 'unread' if item.actual is None else 'drift'
+
+        for item in known:
+            if item not in drift:
+                item.status = 'ok'
+
+        return self.report(items)
+
+    #-------------------------------------------------------------------
+    # Internal functions
+
+    # Read items concurrently, with a few reads in flight and each read
+    # taken from the budget
+    def read_all(self, items):
+        pool = Pool(self.concurrency)
+        for item in items:
+            self.budget.take()
+            pool.spawn(self.read, item)
+        pool.join()
+
+    def read(self, item):
+        try:
+            item.actual = item.read()
+        except (gevent.Timeout, Timeout, TransmitError, QueueFull, Expired) as e:
+            logging.warning("Reconcile read failed: %s %s" % (item, repr(e)))
+            item.actual = None
+
+    def report(self, items):
+        report = {}
+        for item in items:
+            node = report.setdefault(item.node_id, {
+                'configuration': {}, 'associations': {}, 'drift': 0})
+            node[item.SECTION][item.key] = item.status_report()
+            if item.status not in ['ok', 'fixed']:
+                node['drift'] += 1
+
+        return report
+
+class ParameterItem:
+    SECTION = 'configuration'
+
+    def __init__(self, node_id, node, param, value):
+        self.node_id = node_id
+        self.node = node
+        self.key = param
+        self.desired = value
+        self.actual = None
+        self.status = None
+
+        config = node.config.get(param)
+        if config is None:
+            logging.warning("%s: unknown parameter %s" % (node.name, param))
+            self.status = 'unknown'
+            return
+
+        try:
+            self.expected = reported_value(value, config['format'])
+        except struct.error:
+            logging.warning("%s: bad value for %s: %s" % (node.name, param, value))
+            self.status = 'invalid'
+
+    def __str__(self):
+        return "%s %s" % (self.node.name, self.key)
+
+    def read(self):
+        return self.node.get_configuration(self.key, priority=PRIORITY_LOW)
+
+    def matches(self):
+        return self.actual == self.expected
+
+    def write(self):
+        self.node.set_configuration(self.key, self.desired)
+
+    def status_report(self):
+        return {'status': self.status, 'desired': self.desired, 'actual': self.actual}
+
+class AssociationItem:
+    SECTION = 'associations'
+
+    def __init__(self, node_id, node, group, assoc):
+        self.node_id = node_id
+        self.node = node
+        self.key = group
+        self.desired = assoc
+        self.actual = None
+        self.status = None
+
+    def __str__(self):
+        return "%s group %d" % (self.node.name, self.key)
+
+    def read(self):
+        return self.node.get_multi_channel_association(self.key)
+
+    def matches(self):
+        if self.actual is None:
+            return False
+
+        remove, add = association_diff(self.actual, self.desired)
+        return not (remove[0] or remove[1] or add[0] or add[1])
+
+    # Without a current table the group is replaced
+    def write(self):
+        if self.actual is None:
+            self.node.remove_multi_channel_association(self.key, [], [])
+            remove, add = association_diff({}, self.desired)
+        else:
+            remove, add = association_diff(self.actual, self.desired)
+            if remove[0] or remove[1]:
+                self.node.remove_multi_channel_association(self.key, *remove)
+
+        if add[0] or add[1]:
+            self.node.set_multi_channel_association(self.key, *add)
+
+    def status_report(self):
+        return {'status': self.status, 'desired': self.desired, 'actual': self.actual}
@@ -0,0 +1,191 @@
+import collections
+import time
+
+from . import zwave
+
+# Transmit options, in order of escalation after failed delivery
+ROUTE_OPTIONS = [
+    zwave.TRANSMIT_OPTION_ACK,
+    zwave.TRANSMIT_OPTION_ACK | zwave.TRANSMIT_OPTION_AUTO_ROUTE,
+    zwave.TRANSMIT_OPTION_ACK | zwave.TRANSMIT_OPTION_AUTO_ROUTE |
+        zwave.TRANSMIT_OPTION_EXPLORE,
+]
+
+# Consecutive deliveries at a node's level before trying the level below
+DEMOTE_AFTER = 20
+
+# Smoothing factor for success rate and latency
+ROUTE_ALPHA = 0.1
+
+class NodeRoute:
+    def __init__(self):
+        self.level = 0
+        self.streak = 0
+        self.success = 1.0
+        self.latency = None
+
+        # Delivered/failed counts for each level
+        self.outcomes = [[0, 0] for _ in ROUTE_OPTIONS]
+
+    def status(self):
+        return {'options': ROUTE_OPTIONS[self.level],
+                'level': self.level,
+                'success': self.success,
+                'latency': self.latency,
+                'outcomes': [{'options': opt, 'delivered': ok, 'failed': fail}
+                             for opt, (ok, fail) in zip(ROUTE_OPTIONS, self.outcomes)]}
+
+# Per node delivery statistics, used to choose transmit options. A node
+# starts at the level which last worked, escalating on failure and
+# dropping back a level after a run of successful deliveries
+class RouteStats:
+    def __init__(self):
+        self.nodes = {}
+
+    def route(self, node):
+        route = self.nodes.get(node)
+        if route is None:
+            route = self.nodes[node] = NodeRoute()
+        return route
+
+    def level(self, node):
+        return self.route(node).level
+
+    def max_level(self):
+        return len(ROUTE_OPTIONS) - 1
+
+    def options(self, level):
+        return ROUTE_OPTIONS[level]
+
+    # Record delivery outcome (and latency, seconds) at level
+    def record(self, node, level, delivered, latency):
+        route = self.route(node)
+        route.outcomes[level][0 if delivered else 1] += 1
+        route.success += ROUTE_ALPHA * (delivered - route.success)
+
+        if not delivered:
+            if level == route.level:
+                route.streak = 0
+            return
+
+        if route.latency is None:
+            route.latency = latency
+        else:
+            route.latency += ROUTE_ALPHA * (latency - route.latency)
+
+        if level > route.level:
+            route.level = level
+            route.streak = 0
+        elif level == route.level:
+            route.streak += 1
+            if route.streak >= DEMOTE_AFTER and route.level > 0:
+                route.level -= 1
+                route.streak = 0
+
+    def status(self):
+        return {node: route.status() for node, route in self.nodes.items()}
+
+# Estimated delivery time (seconds) for a direct link, and for each hop
+# through a repeater, used until a node's latency has been measured
+DIRECT_LATENCY = 0.05
+HOP_LATENCY = 0.05
+
+# Timeouts allow this multiple of the predicted latency
+LATENCY_TIMEOUT_FACTOR = 4
+
+# Node list from routing information bitmask, bit 0 of the first byte
+# is node 1
+def node_mask(data):
+    return [i * 8 + b + 1 for i, byte in enumerate(data)
+                          for b in range(8) if byte & (1 << b)]
+
+# Network topology from the neighbour tables held by the stick, combined
+# with measured delivery latency to predict latency for each node
+class Topology:
+    def __init__(self, routes):
+        self.routes = routes
+        self.controller_id = None
+
+        # Neighbours by node, and monotonic time they were read
+        self.neighbours = {}
+        self.updated = {}
+
+        # Distance from controller by node, None until needed
+        self.distance = None
+
+    def update(self, node, neighbours):
+        self.neighbours[node] = neighbours
+        self.updated[node] = time.monotonic()
+        self.distance = None
+
+    # Number of repeaters between the controller and node, or None if not
+    # known
+    def hops(self, node):
+        if self.controller_id is None:
+            return None
+
+        if self.distance is None:
+            self.distance = self.find_distance()
+
+        if node not in self.distance:
+            return None
+        return self.distance[node] - 1
+
+    # Breadth first search from the controller, treating neighbour tables
+    # as symmetric
+    def find_distance(self):
+        links = collections.defaultdict(set)
+        for n, neighbours in self.neighbours.items():
+            for m in neighbours:
+                links[n].add(m)
+                links[m].add(n)
+
+        distance = {self.controller_id: 0}
+        queue = collections.deque([self.controller_id])
+        while queue:
+            n = queue.popleft()
+            for m in links[n]:
+                if m not in distance:
+                    distance[m] = distance[n] + 1
+                    queue.append(m)
+
+        return distance
+
+    # Predicted delivery latency (seconds), measured where possible
+    def latency(self, node):
+        route = self.routes.nodes.get(node)
+        if route and route.latency is not None:
+            return route.latency
+
+        hops = self.hops(node)
+        if hops is None:
+            return None
+        return DIRECT_LATENCY + hops * HOP_LATENCY
+
+    # Timeout for a response from node, at least base seconds
+    def timeout(self, node, base):
+        latency = self.latency(node) if node is not None else None
+        if latency is None:
+            return base
+        return max(base, LATENCY_TIMEOUT_FACTOR * latency)
+
+    def status(self):
+        now = time.monotonic()
+
+        nodes = set(self.neighbours) | set(self.routes.nodes)
+        nodes.discard(self.controller_id)
+
+        status = {}
+        for node in sorted(nodes):
+            route = self.routes.nodes.get(node)
+            status[node] = {
+                'neighbours': self.neighbours.get(node),
+                'hops': self.hops(node),
+                'age': now - self.updated[node] if node in self.updated else None,
+                'measured_latency': route.latency if route else None,
+                'predicted_latency': self.latency(node),
+                'route': route.status() if route else None}
+
+        return {'controller': self.controller_id,
+                'controller_neighbours': self.neighbours.get(self.controller_id),
+                'nodes': status}
@@ -0,0 +1,299 @@
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+import gevent
+from gevent.event import Event
+
+from . import zwave
+from .controller import QueueFull
+
+# Longest sleep (seconds) between schedule checks, so wall clock changes
+# are noticed
+SCHEDULE_MAX_SLEEP = 60.0
+
+# Default time (seconds) a run may be late and still be made, with no
+# catch up
+SCHEDULE_GRACE = 60.0
+
+# Time (seconds) to wait for a scheduled command to be delivered
+SCHEDULE_DELIVERY_TIMEOUT = 60.0
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+CATCH_UP = ['latest', 'none']
+
+# Scheduled switch action. spec is the JSON form:
+#
+#   actions:  {switch_id: value, ...}, several switches make a scene
+#   at:       ISO date/time of a single run, or
+#   time:     "HH:MM" local time of a daily run, optionally on
+#   days:     ["mon", ...], or
+#   every:    interval (seconds) of a repeating run
+#   catch_up: "latest" (default) makes the most recent missed run, however
+#             late, "none" only makes runs up to grace seconds late
+#   grace:    seconds, default SCHEDULE_GRACE
+#
+# Missed runs are never replayed in full, only the latest can be made
+class ScheduleEntry:
+    def __init__(self, id, spec, created=None, last_run=None):
+        self.id = id
+        self.spec = spec
+        self.created = created if created is not None else time.time()
+        self.last_run = last_run
+
+        self.catch_up = spec.get('catch_up', 'latest')
+        self.grace = spec.get('grace', SCHEDULE_GRACE)
+
+        if 'at' in spec:
+            self.at = datetime.datetime.fromisoformat(spec['at']).timestamp()
+        elif 'time' in spec:
+            hour, minute = spec['time'].split(":")
+            self.time = datetime.time(int(hour), int(minute))
+            self.days = [DAYS.index(d) for d in spec.get('days', DAYS)]
+
+        self.next_due = self.next_after(last_run if last_run is not None else self.created)
+
+        self.runs = 0
+        self.missed = 0
+        self.failed = 0
+        self.late = None
+
+    # Time of the first run after t, or None
+    def next_after(self, t):
+        if 'at' in self.spec:
+            return self.at if self.at > t else None
+
+        elif 'time' in self.spec:
+            day = datetime.date.fromtimestamp(t)
+            for i in range(8):
+                due = datetime.datetime.combine(day + datetime.timedelta(i), self.time).timestamp()
+                if due > t and (day + datetime.timedelta(i)).weekday() in self.days:
+                    return due
+            return None
+
+        else:
+            every = self.spec['every']
+            n = (t - self.created) // every + 1
+            while self.created + n * every <= t:
+                # Rounding
+                n += 1
+            return self.created + n * every
+
+    def status(self):
+        return {'spec': self.spec,
+                'next_due': self.next_due,
+                'last_run': self.last_run,
+                'runs': self.runs,
+                'missed': self.missed,
+                'failed': self.failed,
+                'late': self.late}
+
+class Scheduler:
+    def __init__(self, switches, path=None):
+        self.switches = switches
+        self.path = path
+
+        self.entries = {}
+        self.schedule = []
+        self.seq = itertools.count()
+        self.changed = Event()
+
+        self.runs = 0
+        self.missed = 0
+        self.failed = 0
+
+    # Check entry spec, raises ValueError
+    def check(self, spec):
+        if type(spec) is not dict:
+            raise ValueError("Schedule must be an object")
+
+        if sum(k in spec for k in ['at', 'time', 'every']) != 1:
+            raise ValueError("Schedule needs one of at, time or every")
+
+        actions = spec.get('actions')
+        if type(actions) is not dict or not actions:
+            raise ValueError("Schedule needs actions")
+        for switch_id, value in actions.items():
+            if switch_id not in self.switches:
+                raise ValueError("Unknown switch: %s" % switch_id)
+            if type(value) is not int:
+                raise ValueError("Bad switch value: %s" % str(value))
+
+        if spec.get('catch_up', 'latest') not in CATCH_UP:
+            raise ValueError("catch_up must be one of %s" % ", ".join(CATCH_UP))
+
+        if 'every' in spec and not (type(spec['every']) in [int, float] and spec['every'] > 0):
+            raise ValueError("Bad interval")
+
+        if 'days' in spec and not (type(spec['days']) is list and spec['days'] and
+                                   all(d in DAYS for d in spec['days'])):
+            raise ValueError("days must be a list of %s" % ", ".join(DAYS))
+
+        try:
+            entry = ScheduleEntry(None, spec)
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError("Bad schedule time")
+
+        if entry.next_due is None:
+            raise ValueError("Schedule time has passed")
+
+    # Add or replace entry
+    def add(self, id, spec):
+        self.check(spec)
+
+        entry = ScheduleEntry(id, spec)
+        self.entries[id] = entry
+        self.queue(entry)
+        self.save()
+
+    def remove(self, id):
+        if self.entries.pop(id, None) is None:
+            return False
+
+        self.save()
+        return True
+
+    def status(self):
+        return {'entries': len(self.entries),
+                'runs': self.runs,
+                'missed': self.missed,
+                'failed': self.failed}
+
+    # Load saved entries, and the time of their last run so runs missed
+    # while stopped are caught up
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            saved = json.load(f)
+
+        for id, e in saved.items():
+            try:
+                entry = ScheduleEntry(id, e['spec'], e['created'], e.get('last_run'))
+            except (ValueError, TypeError, AttributeError, KeyError) as err:
+                logging.warning("Schedule %s dropped: %s" % (id, repr(err)))
+                continue
+
+            self.entries[id] = entry
+            self.queue(entry)
+
+    def save(self):
+        if not self.path:
+            return
+
+        saved = {id: {'spec': e.spec, 'created': e.created, 'last_run': e.last_run}
+                 for id, e in self.entries.items()}
+
+        # Replace file atomically
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(saved, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def start(self):
+        self.load()
+        gevent.spawn(self.run)
+
+    #-------------------------------------------------------------------
+    # Internal functions
+
+    def queue(self, entry):
+        if entry.next_due is not None:
+            heapq.heappush(self.schedule, (entry.next_due, next(self.seq), entry))
+        self.changed.set()
+
+    def run(self):
+        while 1:
+            self.changed.clear()
+
+            now = time.time()
+            while self.schedule and self.schedule[0][0] <= now:
+                due, _, entry = heapq.heappop(self.schedule)
+
+                # Skip removed or replaced entries
+                if self.entries.get(entry.id) is entry and entry.next_due == due:
+                    self.fire(entry, now)
+
+            delay = SCHEDULE_MAX_SLEEP
+            if self.schedule:
+                delay = min(delay, self.schedule[0][0] - now)
+
+            self.changed.wait(delay)
+
+    def fire(self, entry, now):
+        # Find the latest run due, earlier ones are missed
+        due = entry.next_due
+        missed = 0
+        while True:
+            next_due = entry.next_after(due)
+            if next_due is None or next_due > now:
+                break
+            due = next_due
+            missed += 1
+
+        late = now - due
+        if entry.catch_up == 'none' and late > entry.grace:
+            missed += 1
+        else:
+            self.execute(entry)
+            entry.runs += 1
+            entry.late = late
+            self.runs += 1
+
+        if missed:
+            logging.warning("Schedule %s: %d runs missed" % (entry.id, missed))
+            entry.missed += missed
+            self.missed += missed
+
+        entry.last_run = now
+        entry.next_due = entry.next_after(now)
+        if entry.next_due is None:
+            del self.entries[entry.id]
+        else:
+            self.queue(entry)
+
+        self.save()
+
+    def execute(self, entry):
+        logging.info("Schedule %s: %s" % (entry.id, entry.spec['actions']))
+
+        msgs = []
+        for switch_id, value in entry.spec['actions'].items():
+            switch = self.switches.get(switch_id)
+            if switch is None:
+                logging.warning("Schedule %s: unknown switch %s" % (entry.id, switch_id))
+                self.failure(entry)
+                continue
+
+            try:
+                msgs.append(switch.set(value))
+            except QueueFull:
+                logging.warning("Schedule %s: queue full, %s not set" % (entry.id, switch_id))
+                self.failure(entry)
+
+        if msgs:
+            gevent.spawn(self.check_delivery, entry, msgs)
+
+    def check_delivery(self, entry, msgs):
+        for msg in msgs:
+            try:
+                status = msg.result.get(timeout=SCHEDULE_DELIVERY_TIMEOUT)
+            except (Exception, gevent.Timeout) as e:
+                logging.warning("Schedule %s: delivery failed %s" % (entry.id, repr(e)))
+                self.failure(entry)
+                continue
+
+            # Node not reached
+            if status != zwave.TRANSMIT_COMPLETE_OK:
+                logging.warning("Schedule %s: transmit status %d" % (entry.id, status))
+                self.failure(entry)
+
+    def failure(self, entry):
+        entry.failed += 1
+        self.failed += 1
@@ -1,5 +1,6 @@
 import functools
 import itertools
+import logging
 import struct
 
 from . import command
@@ -21,10 +22,37 @@ def _(cmd):
 
 @serialize.register(command.BasicSet)
 @serialize.register(command.BinarySwitchSet)
-@serialize.register(command.MultilevelSwitchSet)
 def _(cmd):
     return list(cmd.sig()) + [cmd.value]
 
+# Duration in seconds up to 127, then minutes
+def serialize_duration(duration):
+    if duration is None:
+        return zwave.DURATION_DEFAULT
+    elif duration <= 127:
+        return round(duration)
+    else:
+        return 0x7f + min(round(duration / 60), 127)
+
+# Version 1 form unless a duration is given
+@serialize.register(command.MultilevelSwitchSet)
+def _(cmd):
+    data = list(cmd.sig()) + [cmd.value]
+    if cmd.duration is not None:
+        data.append(serialize_duration(cmd.duration))
+    return data
+
+@serialize.register(command.MultilevelSwitchStartLevelChange)
+def _(cmd):
+    flags = 0 if cmd.up else zwave.SWITCH_MULTILEVEL_DOWN
+    if cmd.start_level is None:
+        flags |= zwave.SWITCH_MULTILEVEL_IGNORE_START_LEVEL
+
+    data = list(cmd.sig()) + [flags, cmd.start_level or 0]
+    if cmd.duration is not None:
+        data.append(serialize_duration(cmd.duration))
+    return data
+
 @serialize.register(command.ConfigurationSet)
 def _(cmd):
     return list(cmd.sig()) + \
@@ -46,6 +74,14 @@ def _(cmd):
 def _(cmd):
     return list(cmd.sig()) + [0, cmd.endpoint] + serialize(cmd.command)
 
+@serialize.register(command.MultiCommandEncap)
+def _(cmd):
+    data = list(cmd.sig()) + [len(cmd.commands)]
+    for c in cmd.commands:
+        frame = serialize(c)
+        data += [len(frame)] + frame
+    return data
+
 #----------------------------------------------------------------------
 
 class lookup:
@@ -92,6 +128,7 @@ def _(cmd, data):
     cmd.value = data[0]
 
 @deserialize.register(command.MeterReport)
+@deserialize.register(command.WakeUpNotification)
 def _(cmd, data):
     pass
 
@@ -108,11 +145,29 @@ def _(cmd, data):
     n = len(cmd.nodes) + 4
     cmd.multi_channel_nodes = list(zip(data[n::2], data[n+1::2]))
 
+@deserialize.register(command.MultiChannelAssociationGroupingsReport)
+def _(cmd, data):
+    cmd.groupings = data[0]
+
 @deserialize.register(command.MultiChannelEncap)
 def _(cmd, data):
     cmd.endpoint = data[0]
     cmd.command = deserialize(data[2:])
 
+# Unknown embedded commands are skipped, keeping the others
+@deserialize.register(command.MultiCommandEncap)
+def _(cmd, data):
+    cmd.commands = []
+    n = 1
+    for i in range(data[0]):
+        size = data[n]
+        embedded = data[n+1:n+1+size]
+        try:
+            cmd.commands.append(deserialize(embedded))
+        except DeserializeError:
+            logging.warning("Can't deserialize embedded command %s" % zwave.msg_str(embedded))
+        n += size + 1
+
 @deserialize.register(command.ConfigurationReport)
 def _(cmd, data):
     cmd.parameter = data[0]
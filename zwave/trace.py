@@ -0,0 +1,79 @@
+import json
+import logging
+import socket
+import time
+
+from gevent.local import local
+
+# Per-request trace of stage timings. The trace is attached to the
+# current greenlet, and carried with queued messages to the transmitter
+_current = local()
+_exporter = None
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.time()
+        self.start = time.monotonic()
+        self.end = self.start
+        self.spans = []
+
+    # Record span, start and end are monotonic times
+    def add(self, name, start, end):
+        self.spans.append((name, start, end))
+        self.end = max(self.end, end)
+
+    def server_timing(self):
+        timings = ["%s;dur=%.1f" % (name, (end - start) * 1000)
+                   for name, start, end in self.spans]
+        timings.append("total;dur=%.1f" % ((time.monotonic() - self.start) * 1000))
+        return ", ".join(timings)
+
+    def to_dict(self):
+        return {'name': self.name,
+                'start': self.wall,
+                'duration': (time.monotonic() - self.start) * 1000,
+                'spans': [{'name': name,
+                           'start': (start - self.start) * 1000,
+                           'duration': (end - start) * 1000}
+                          for name, start, end in self.spans]}
+
+# Start trace for current greenlet
+def start(name):
+    trace = Trace(name)
+    _current.trace = trace
+    return trace
+
+def current():
+    return getattr(_current, 'trace', None)
+
+# Detach trace from current greenlet and export it
+def finish():
+    trace = current()
+    _current.trace = None
+
+    if trace and _exporter:
+        try:
+            _exporter(json.dumps(trace.to_dict()))
+        except OSError as e:
+            logging.warning("Trace export failed: %s" % str(e))
+
+    return trace
+
+# Export finished traces as JSON lines to a file, or as UDP datagrams
+# to a collector given as udp://host:port
+def set_exporter(target):
+    global _exporter
+
+    if target is None:
+        _exporter = None
+
+    elif target.startswith("udp://"):
+        host, port = target[6:].rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        addr = (host, int(port))
+        _exporter = lambda line: sock.sendto(line.encode(), addr)
+
+    else:
+        f = open(target, "a", buffering=1)
+        _exporter = lambda line: f.write(line + "\n")
@@ -0,0 +1,86 @@
+import socket
+import time
+
+import serial
+
+# Time (seconds) for read to wait for data
+READ_TIMEOUT = 1.0
+
+# Serial API transports. All have read(n), returning up to n bytes
+# (fewer on timeout), write(data) and close()
+
+# Local serial device
+class SerialTransport:
+    def __init__(self, dev, timeout=READ_TIMEOUT):
+        self.ser = serial.Serial(dev, timeout=timeout)
+
+    def read(self, n=1):
+        return self.ser.read(n)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def close(self):
+        self.ser.close()
+
+# Stream socket, e.g. a ser2net bridge or a local simulator. Data is
+# received in blocks and buffered for the frame parser
+class SocketTransport:
+    def __init__(self, sock, timeout=READ_TIMEOUT):
+        self.sock = sock
+        self.timeout = timeout
+        self.buf = bytearray()
+
+    def read(self, n=1):
+        deadline = time.monotonic() + self.timeout
+        while len(self.buf) < n:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                break
+
+            if not data:
+                raise ConnectionError("Connection closed by peer")
+            self.buf += data
+
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def write(self, data):
+        self.sock.sendall(bytes(data))
+
+    def close(self):
+        self.sock.close()
+
+# TCP connection, tcp://host:port
+def open_tcp(addr, timeout=READ_TIMEOUT):
+    host, port = addr.rsplit(":", 1)
+    sock = socket.create_connection((host, int(port)), timeout=timeout)
+
+    # Frames are small and latency sensitive
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return SocketTransport(sock, timeout)
+
+# Unix domain socket, unix:///path
+def open_unix(path, timeout=READ_TIMEOUT):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(path)
+    return SocketTransport(sock, timeout)
+
+# Open transport from device name, tcp://host:port, unix:///path or a
+# serial device
+def open_transport(dev, timeout=READ_TIMEOUT):
+    if dev.startswith("tcp://"):
+        return open_tcp(dev[6:], timeout)
+    elif dev.startswith("unix://"):
+        return open_unix(dev[7:], timeout)
+    else:
+        return SerialTransport(dev, timeout)
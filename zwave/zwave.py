@@ -70,7 +70,12 @@ API_GET_INIT_DATA = 0x02
 API_APP_COMMAND_HANDLER = 0x04
 API_ZW_SEND_DATA = 0x13
 API_ZW_GET_VERSION = 0x15
+API_MEMORY_GET_ID = 0x20
 API_ZW_REQUEST_NODE_INFO = 0x60
+API_ZW_GET_ROUTING_INFO = 0x80
+
+# Routing information node bitmask length
+NODE_MASK_LEN = 29
 
 #-----------------------------------------------------------------------
 # Command classes/types
@@ -89,13 +94,28 @@ COMMAND_CLASS_SWITCH_MULTILEVEL = 0x26
 SWITCH_MULTILEVEL_SET = 0x1
 SWITCH_MULTILEVEL_GET = 0x2
 SWITCH_MULTILEVEL_REPORT = 0x3
+SWITCH_MULTILEVEL_START_LEVEL_CHANGE = 0x4
+SWITCH_MULTILEVEL_STOP_LEVEL_CHANGE = 0x5
+
+# Level change flags
+SWITCH_MULTILEVEL_DOWN = 0x40
+SWITCH_MULTILEVEL_IGNORE_START_LEVEL = 0x20
+
+# Transition duration, 0 is instant, 0xff device default
+DURATION_DEFAULT = 0xff
+MAX_DURATION = 127 * 60
 
 COMMAND_CLASS_METER = 0x32
+METER_GET = 0x01
 METER_REPORT = 0x02
 
 COMMAND_CLASS_MULTI_CHANNEL = 0x60
 MULTI_CHANNEL_CMD_ENCAP = 0x0D
 
+COMMAND_CLASS_WAKE_UP = 0x84
+WAKE_UP_NOTIFICATION = 0x07
+WAKE_UP_NO_MORE_INFORMATION = 0x08
+
 COMMAND_CLASS_CONFIGURATION = 0x70
 CONFIGURATION_SET = 0x04
 CONFIGURATION_GET = 0x05
@@ -107,10 +127,18 @@ ASSOCIATION_GET = 0x02
 ASSOCIATION_REPORT = 0x03
 ASSOCIATION_REMOVE = 0x04
 
+COMMAND_CLASS_MULTI_CMD = 0x8f
+MULTI_CMD_ENCAP = 0x01
+
+# Maximum command payload in a single (non-secure) frame
+MAX_PAYLOAD = 46
+
 COMMAND_CLASS_MULTI_CHANNEL_ASSOCIATION_V2 = 0x8e
 MULTI_CHANNEL_ASSOCIATION_SET_V2 = 0x01
 MULTI_CHANNEL_ASSOCIATION_GET_V2 = 0x02
 MULTI_CHANNEL_ASSOCIATION_REPORT_V2 = 0x03
 MULTI_CHANNEL_ASSOCIATION_REMOVE_V2 = 0x04
+MULTI_CHANNEL_ASSOCIATION_GROUPINGS_GET_V2 = 0x05
+MULTI_CHANNEL_ASSOCIATION_GROUPINGS_REPORT_V2 = 0x06
 MULTI_CHANNEL_ASSOCIATION_SET_MARKER_V2 = 0x00
 MULTI_CHANNEL_ASSOCIATION_REMOVE_MARKER_V2 = 0x00
@@ -0,0 +1,3 @@
+from .common import ClientError, VerifyError, retry_delay
+from .client import Client
+from .aio import AsyncClient
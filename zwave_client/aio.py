@@ -0,0 +1,156 @@
+import asyncio
+from json import loads as json_loads
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .common import *
+
+# Asynchronous client, with the same methods as Client. Needs aiohttp
+class AsyncClient:
+    def __init__(self, url, retries=RETRIES, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, timeout=TIMEOUT):
+        if aiohttp is None:
+            raise ImportError("AsyncClient requires aiohttp")
+
+        self.url = url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=timeout))
+
+        # Listing cache, path: (etag, value)
+        self.listings = {}
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    # Returns (status, headers, decoded JSON body or None)
+    async def request(self, method, path, json=None, params=None, headers=None):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                async with self.session.request(method, self.url + path,
+                        json=json, params=params, headers=headers) as resp:
+                    body = await resp.read()
+                    status, resp_headers = resp.status, resp.headers
+            except aiohttp.ClientConnectionError:
+                if last:
+                    raise
+                await asyncio.sleep(
+                        retry_delay(attempt, None, self.backoff, self.max_backoff))
+                continue
+
+            if status in RETRY_STATUS and not last:
+                await asyncio.sleep(retry_delay(attempt, resp_headers.get('Retry-After'),
+                                                self.backoff, self.max_backoff))
+                continue
+
+            if status >= 400 and status != 409:
+                raise ClientError(status, body.decode(errors="replace"))
+
+            value = json_loads(body) if body and status != 304 else None
+            return status, resp_headers, value
+
+    async def call(self, method, path, json=None, params=None):
+        return (await self.request(method, path, json, params))[2]
+
+    async def listing(self, path):
+        cached = self.listings.get(path)
+        headers = {'If-None-Match': cached[0]} if cached else None
+
+        status, resp_headers, value = await self.request("GET", path, headers=headers)
+        if status == 304:
+            return cached[1]
+
+        if resp_headers.get('ETag'):
+            self.listings[path] = (resp_headers['ETag'], value)
+        return value
+
+    # Switches
+    async def switches(self):
+        return await self.listing(switch_path())
+
+    async def get_switch(self, switch_id):
+        return await self.call("GET", switch_path(switch_id))
+
+    async def set_switch(self, switch_id, value, verify=False, timeout=None,
+                         duration=None):
+        params = {}
+        if verify:
+            params['verify'] = 1
+        if timeout is not None:
+            params['timeout'] = timeout
+
+        body = value
+        if duration is not None:
+            body = {'value': value, 'duration': duration}
+
+        status, _, actual = await self.request("PUT", switch_path(switch_id),
+                                               body, params)
+        if status == 409:
+            raise VerifyError(value, actual)
+
+        return actual if verify else None
+
+    async def set_switches(self, values):
+        return await self.call("PUT", switch_path(), values)
+
+    # Start dimming "up" or "down", or "stop"
+    async def level_change(self, switch_id, direction, start_level=None, duration=None):
+        change = {'level_change': direction}
+        if start_level is not None:
+            change['start_level'] = start_level
+        if duration is not None:
+            change['duration'] = duration
+
+        return await self.call("PUT", switch_path(switch_id), change)
+
+    # Nodes
+    async def nodes(self):
+        return await self.listing("/api/node/")
+
+    async def config_params(self, node_id):
+        return await self.listing(node_path(node_id, "config", ""))
+
+    async def get_config(self, node_id, param):
+        return await self.call("GET", node_path(node_id, "config", param))
+
+    async def set_config(self, node_id, param, value):
+        return await self.call("PUT", node_path(node_id, "config", param), value)
+
+    # Associations
+    async def associations(self, node_id, refresh=False):
+        params = {'refresh': 1} if refresh else None
+        table = await self.call("GET",
+                node_path(node_id, "multi_channel_association", ""), params=params)
+        return {int(g): a for g, a in table.items()}
+
+    async def set_associations(self, node_id, table):
+        changes = await self.call("PUT",
+                node_path(node_id, "multi_channel_association", ""), table)
+        return {int(g): c for g, c in changes.items()}
+
+    async def reconcile(self, dry_run=False, budget=None):
+        params = {'dry_run': 1} if dry_run else {}
+        if budget is not None:
+            params['budget'] = budget
+        return await self.call("POST", "/api/reconcile", params=params)
+
+    # Service
+    async def health(self):
+        return await self.call("GET", "/healthz")
+
+    async def ready(self):
+        async with self.session.get(self.url + "/readyz") as resp:
+            return resp.status == 200
@@ -0,0 +1,157 @@
+import time
+
+import requests
+
+from .common import *
+
+# Synchronous client for the Z-Wave REST service, using a keep-alive
+# session. Requests are retried on connection errors and 429/5xx
+# responses, with backoff following the server's Retry-After hint
+class Client:
+    def __init__(self, url, retries=RETRIES, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+
+        # Listing cache, path: (etag, value)
+        self.listings = {}
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, method, path, json=None, params=None, headers=None):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                resp = self.session.request(method, self.url + path, json=json,
+                        params=params, headers=headers, timeout=self.timeout)
+            except requests.ConnectionError:
+                if last:
+                    raise
+                time.sleep(retry_delay(attempt, None, self.backoff, self.max_backoff))
+                continue
+
+            if resp.status_code in RETRY_STATUS and not last:
+                time.sleep(retry_delay(attempt, resp.headers.get('Retry-After'),
+                                       self.backoff, self.max_backoff))
+                continue
+
+            return resp
+
+    def call(self, method, path, json=None, params=None):
+        resp = self.request(method, path, json, params)
+        if resp.status_code >= 400:
+            raise ClientError(resp.status_code, resp.text)
+
+        return resp.json() if resp.content else None
+
+    # Listing, revalidated with the cached ETag
+    def listing(self, path):
+        cached = self.listings.get(path)
+        headers = {'If-None-Match': cached[0]} if cached else None
+
+        resp = self.request("GET", path, headers=headers)
+        if resp.status_code == 304:
+            return cached[1]
+        elif resp.status_code >= 400:
+            raise ClientError(resp.status_code, resp.text)
+
+        value = resp.json()
+        if resp.headers.get('ETag'):
+            self.listings[path] = (resp.headers['ETag'], value)
+        return value
+
+    # Switches
+    def switches(self):
+        return self.listing(switch_path())
+
+    def get_switch(self, switch_id):
+        return self.call("GET", switch_path(switch_id))
+
+    # Set switch. With verify the value is read back and VerifyError
+    # raised if it doesn't match
+    def set_switch(self, switch_id, value, verify=False, timeout=None,
+                   duration=None):
+        params = {}
+        if verify:
+            params['verify'] = 1
+        if timeout is not None:
+            params['timeout'] = timeout
+
+        body = value
+        if duration is not None:
+            body = {'value': value, 'duration': duration}
+
+        resp = self.request("PUT", switch_path(switch_id), body, params)
+        if resp.status_code == 409:
+            raise VerifyError(value, resp.json())
+        elif resp.status_code >= 400:
+            raise ClientError(resp.status_code, resp.text)
+
+        return resp.json() if verify else None
+
+    # Set several switches, switch: value. Returns status by switch
+    def set_switches(self, values):
+        return self.call("PUT", switch_path(), values)
+
+    # Start dimming "up" or "down", or "stop"
+    def level_change(self, switch_id, direction, start_level=None, duration=None):
+        change = {'level_change': direction}
+        if start_level is not None:
+            change['start_level'] = start_level
+        if duration is not None:
+            change['duration'] = duration
+
+        return self.call("PUT", switch_path(switch_id), change)
+
+    # Nodes
+    def nodes(self):
+        return self.listing("/api/node/")
+
+    def config_params(self, node_id):
+        return self.listing(node_path(node_id, "config", ""))
+
+    def get_config(self, node_id, param):
+        return self.call("GET", node_path(node_id, "config", param))
+
+    def set_config(self, node_id, param, value):
+        return self.call("PUT", node_path(node_id, "config", param), value)
+
+    # Associations
+    def associations(self, node_id, refresh=False):
+        params = {'refresh': 1} if refresh else None
+        table = self.call("GET", node_path(node_id, "multi_channel_association", ""),
+                          params=params)
+        return {int(g): a for g, a in table.items()}
+
+    # Update association table, returning the changes made
+    def set_associations(self, node_id, table):
+        changes = self.call("PUT", node_path(node_id, "multi_channel_association", ""),
+                            table)
+        return {int(g): c for g, c in changes.items()}
+
+    # Bring nodes to their declared configuration, returning drift by node
+    def reconcile(self, dry_run=False, budget=None):
+        params = {'dry_run': 1} if dry_run else {}
+        if budget is not None:
+            params['budget'] = budget
+        return self.call("POST", "/api/reconcile", params=params)
+
+    # Service
+    def health(self):
+        return self.call("GET", "/healthz")
+
+    def ready(self):
+        resp = self.session.get(self.url + "/readyz", timeout=self.timeout)
+        return resp.status_code == 200
@@ -0,0 +1,44 @@
+import random
+
+# Default retry policy
+RETRIES = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+# Default HTTP timeout (seconds)
+TIMEOUT = 10.0
+
+# Responses worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class ClientError(Exception):
+    def __init__(self, status, message=""):
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return "HTTP %d: %s" % (self.status, self.message)
+
+# Switch didn't reach requested value
+class VerifyError(ClientError):
+    def __init__(self, value, actual):
+        super().__init__(409, "switch value %s, expected %s" % (actual, value))
+        self.value = value
+        self.actual = actual
+
+# Delay before retry, the server's Retry-After hint if given, otherwise
+# exponential backoff with full jitter
+def retry_delay(attempt, retry_after=None, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    if retry_after:
+        try:
+            return min(float(retry_after), max_backoff) + random.uniform(0, backoff)
+        except ValueError:
+            pass
+
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+def switch_path(switch_id=""):
+    return "/api/switch/%s" % switch_id
+
+def node_path(node_id, *parts):
+    return "/".join(["/api/node", str(node_id)] + [str(p) for p in parts])